@@ -0,0 +1,104 @@
+"""
+Password hashing, login and registration.
+"""
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+from sqlalchemy.exc import IntegrityError
+
+import instrumentation
+from models import User
+
+# bcrypt cost factor for new hashes; existing hashes are upgraded on login
+BCRYPT_ROUNDS = int(os.environ.get('CORDINATE_BCRYPT_ROUNDS', '12'))
+BCRYPT_PREFIXES = ('$2a$', '$2b$', '$2y$')
+
+def hash_password(password):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
+
+def check_password(hashed_password, plain_password):
+    return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+# bcrypt runs on a bounded pool, which caps how many hashes are computed at
+# once so a login burst cannot take every core; the calling script thread
+# still waits for its hash, including any time queued. Each username gets
+# a limited number of attempts per window.
+AUTH_WORKERS = 4
+AUTH_ATTEMPTS = 5
+AUTH_WINDOW_SECONDS = 60
+
+class TooManyAttempts(Exception):
+    pass
+
+class RateLimiter:
+    """
+    Sliding-window limit of attempts per key.
+    """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.attempts = {}
+        self.lock = threading.Lock()
+
+    def allow(self, key):
+        now = time.monotonic()
+        with self.lock:
+            attempts = self.attempts.setdefault(key, deque())
+            while attempts and attempts[0] <= now - self.window:
+                attempts.popleft()
+            if len(attempts) >= self.limit:
+                return False
+            attempts.append(now)
+            if len(self.attempts) > 10000:
+                self.attempts = {
+                    key: attempts for key, attempts in self.attempts.items()
+                    if attempts and attempts[-1] > now - self.window
+                }
+            return True
+
+# Shared by every session of the process; the pool starts its threads on
+# first use.
+_executor = ThreadPoolExecutor(max_workers=AUTH_WORKERS)
+_limiter = RateLimiter(AUTH_ATTEMPTS, AUTH_WINDOW_SECONDS)
+
+# Logged-in user kept in the Streamlit session state. Only plain values are
+# stored there; ORM objects stay bound to the session of a single run.
+SessionUser = namedtuple('SessionUser', ['id', 'username'])
+
+@instrumentation.timed('auth')
+def authenticate(session, username, password):
+    """
+    Return the SessionUser for valid credentials, None otherwise.
+    Raises TooManyAttempts when the username is rate limited.
+    """
+    if not _limiter.allow(username):
+        raise TooManyAttempts(username)
+    user = session.query(User).filter_by(username=username).first()
+    if user is None:
+        return None
+    if not _executor.submit(check_password, user.password, password).result():
+        return None
+    # Upgrade hashes created with a different cost factor
+    if int(user.password.split('$')[2]) != BCRYPT_ROUNDS:
+        user.password = _executor.submit(hash_password, password).result()
+        session.commit()
+    return SessionUser(user.id, user.username)
+
+@instrumentation.timed('auth')
+def register(session, username, password):
+    if not _limiter.allow(username):
+        raise TooManyAttempts(username)
+    hashed_password = _executor.submit(hash_password, password).result()
+    new_user = User(username=username, password=hashed_password)
+    try:
+        session.add(new_user)
+        session.commit()
+        return SessionUser(new_user.id, new_user.username)
+    except IntegrityError:
+        session.rollback()
+        return None
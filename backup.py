@@ -0,0 +1,371 @@
+"""
+Incremental backup archives of the database and the upload directory,
+and restoring them.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import warnings
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import instrumentation
+from database import DB_PATH, get_engine, init_schema
+from storage import UPLOAD_DIR, THUMBNAIL_DIR, clear_directory_snapshots
+from suggestions import invalidate_suggestion_indexes
+
+BACKUP_DIR = 'backups'
+
+# The backup archive is updated incrementally; the manifest next to it
+# records size, mtime and sha256 of every file already in the archive.
+BACKUP_FILE = os.path.join(BACKUP_DIR, 'fashion_backup.zip')
+BACKUP_MANIFEST = os.path.join(BACKUP_DIR, 'manifest.json')
+# Appends overwrite the archive's central directory; it is saved here
+# first, with its offset, so that an interrupted append can be undone
+BACKUP_JOURNAL = BACKUP_FILE + '.journal'
+# Formats that are already compressed are stored without recompression
+STORED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.heic', '.heif', '.webp'}
+
+# Parallel file writers used when restoring a backup
+RESTORE_WORKERS = 8
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def snapshot_database(snapshot_path):
+    """
+    Copy the live database through the SQLite online backup API, which
+    yields a consistent copy even while other connections write.
+    """
+    source = sqlite3.connect(DB_PATH)
+    target = sqlite3.connect(snapshot_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+def _save_archive_tail():
+    with zipfile.ZipFile(BACKUP_FILE) as zipf:
+        offset = zipf.start_dir
+    with open(BACKUP_FILE, 'rb') as f:
+        f.seek(offset)
+        tail = f.read()
+    tmp_journal = BACKUP_JOURNAL + '.tmp'
+    with open(tmp_journal, 'wb') as f:
+        f.write(offset.to_bytes(8, 'little'))
+        f.write(tail)
+    os.replace(tmp_journal, BACKUP_JOURNAL)
+
+def _rollback_archive():
+    """
+    Cut the archive back to the state saved by _save_archive_tail(), if an
+    append did not complete.
+    """
+    if not os.path.exists(BACKUP_JOURNAL):
+        return
+    with open(BACKUP_JOURNAL, 'rb') as f:
+        offset = int.from_bytes(f.read(8), 'little')
+        tail = f.read()
+    with open(BACKUP_FILE, 'r+b') as f:
+        f.truncate(offset)
+        f.seek(offset)
+        f.write(tail)
+    os.remove(BACKUP_JOURNAL)
+
+def _load_backup_manifest():
+    if not os.path.exists(BACKUP_FILE) or not os.path.exists(BACKUP_MANIFEST):
+        return None
+    try:
+        with open(BACKUP_MANIFEST) as f:
+            manifest = json.load(f)
+        # A damaged or foreign archive is rebuilt from scratch
+        with zipfile.ZipFile(BACKUP_FILE):
+            pass
+    except (ValueError, OSError, zipfile.BadZipFile):
+        return None
+    return manifest
+
+@instrumentation.timed('backup')
+def create_backup(progress=None):
+    """
+    Update the backup archive incrementally and return its path.
+
+    Only upload files that are new or whose content changed since the last
+    backup are appended to the archive; the database is always added as a
+    fresh snapshot. The archive's manifest.json lists the sha256 of every
+    file that belongs to the backup. Superseded entries stay in the archive
+    until they take more space than the live ones, at which point it is
+    rewritten. An append that fails or is killed half way is undone,
+    here or at the start of the next backup, so the previous backup stays
+    intact; a rewrite goes to a new file that replaces the archive.
+    Files that disappear while the backup runs, such as deleted images,
+    are left out of it.
+    progress(done, total) is called as files are written.
+    """
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    _rollback_archive()
+    manifest = _load_backup_manifest()
+    rebuild = manifest is None or manifest['stale_bytes'] > manifest['database_size'] + sum(
+        entry['size'] for entry in manifest['files'].values()
+    )
+    previous = {} if rebuild else manifest['files']
+    # The previous database snapshot and manifest.json are superseded every time
+    stale_bytes = 0 if rebuild else manifest['stale_bytes'] + manifest['database_size']
+
+    files = {}
+    changed = []
+    for root, dirs, file_names in os.walk(UPLOAD_DIR):
+        for file in file_names:
+            # Partial files of uploads in progress are always renamed away
+            if file.endswith('.tmp'):
+                continue
+            file_path = os.path.join(root, file)
+            arcname = os.path.relpath(file_path, UPLOAD_DIR)
+            try:
+                stat = os.stat(file_path)
+                entry = previous.get(arcname)
+                if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                    files[arcname] = entry
+                    continue
+                sha256 = file_sha256(file_path)
+            except FileNotFoundError:
+                continue
+            files[arcname] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}
+            if entry and entry['sha256'] == sha256:
+                continue
+            if entry:
+                stale_bytes += entry['size']
+            changed.append((file_path, arcname))
+    stale_bytes += sum(entry['size'] for arcname, entry in previous.items() if arcname not in files)
+
+    total = len(changed) + 1
+    if progress:
+        progress(0, total)
+    snapshot_path = os.path.join(BACKUP_DIR, 'fashion.db.snapshot')
+    snapshot_database(snapshot_path)
+    database_size = os.path.getsize(snapshot_path)
+    archive_manifest = {
+        'version': 1,
+        'database': {'sha256': file_sha256(snapshot_path)},
+        'files': {arcname: {'size': entry['size'], 'sha256': entry['sha256']} for arcname, entry in files.items()},
+    }
+    tmp_archive = BACKUP_FILE + '.tmp'
+    if not rebuild:
+        _save_archive_tail()
+    try:
+        with warnings.catch_warnings():
+            # Replaced entries are appended under the same name; readers use the last one
+            warnings.simplefilter('ignore', UserWarning)
+            with zipfile.ZipFile(
+                tmp_archive if rebuild else BACKUP_FILE, 'w' if rebuild else 'a', zipfile.ZIP_DEFLATED
+            ) as zipf:
+                zipf.write(snapshot_path, os.path.basename(DB_PATH))
+                if progress:
+                    progress(1, total)
+                for done, (file_path, arcname) in enumerate(changed, start=2):
+                    extension = os.path.splitext(file_path)[1].lower()
+                    compress_type = zipfile.ZIP_STORED if extension in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+                    try:
+                        zipf.write(file_path, arcname, compress_type=compress_type)
+                    except FileNotFoundError:
+                        # Deleted since the scan
+                        del files[arcname]
+                        del archive_manifest['files'][arcname]
+                    if progress:
+                        progress(done, total)
+                zipf.writestr('manifest.json', json.dumps(archive_manifest))
+        if rebuild:
+            os.replace(tmp_archive, BACKUP_FILE)
+    except BaseException:
+        _rollback_archive()
+        raise
+    finally:
+        for path in (tmp_archive, snapshot_path):
+            if os.path.exists(path):
+                os.remove(path)
+    # Before the manifest: should this process die in between, the next
+    # backup only appends the changed files again
+    if os.path.exists(BACKUP_JOURNAL):
+        os.remove(BACKUP_JOURNAL)
+
+    tmp_manifest = BACKUP_MANIFEST + '.tmp'
+    with open(tmp_manifest, 'w') as f:
+        json.dump({'files': files, 'database_size': database_size, 'stale_bytes': stale_bytes}, f)
+    os.replace(tmp_manifest, BACKUP_MANIFEST)
+    return BACKUP_FILE
+
+def restore_destination(arcname):
+    """
+    Map an archive member name to its path under UPLOAD_DIR, rejecting
+    absolute paths and names that would escape the directory.
+    """
+    upload_root = os.path.realpath(UPLOAD_DIR)
+    destination = os.path.realpath(os.path.join(upload_root, arcname))
+    if os.path.isabs(arcname) or os.path.commonpath([upload_root, destination]) != upload_root \
+            or destination == upload_root:
+        raise ValueError(f"不正なパスがバックアップに含まれています: {arcname}")
+    return destination
+
+def _file_crc32(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+def extract_member(zipf, info, destination, sha256=None):
+    """
+    Stream one archive member to destination through a temporary file,
+    verifying it against the manifest checksum before it replaces the
+    destination. Returns False when an identical file is already there.
+    """
+    if os.path.exists(destination) and os.path.getsize(destination) == info.file_size:
+        if sha256 is not None and file_sha256(destination) == sha256:
+            return False
+        if sha256 is None and _file_crc32(destination) == info.CRC:
+            return False
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    tmp_path = destination + '.restore'
+    digest = hashlib.sha256()
+    try:
+        with zipf.open(info) as src, open(tmp_path, 'wb') as dst:
+            for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                digest.update(chunk)
+                dst.write(chunk)
+        if sha256 is not None and digest.hexdigest() != sha256:
+            raise ValueError(f"チェックサムが一致しません: {info.filename}")
+        os.replace(tmp_path, destination)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return True
+
+def _copy_live_jobs(snapshot):
+    """
+    Replace the jobs table of an extracted database snapshot with the live
+    one. Jobs queued while a restore runs, and the restore job itself,
+    survive it, and the jobs that were queued or running when the archive
+    was made never come back to life.
+    """
+    snapshot.execute("ATTACH DATABASE ? AS live", (DB_PATH,))
+    try:
+        with snapshot:
+            # The table before its indexes
+            statements = snapshot.execute(
+                "SELECT sql FROM live.sqlite_master WHERE tbl_name = 'jobs' AND sql IS NOT NULL ORDER BY type DESC"
+            ).fetchall()
+            if statements:
+                snapshot.execute("DROP TABLE IF EXISTS main.jobs")
+                for (sql,) in statements:
+                    snapshot.execute(sql)
+                snapshot.execute("INSERT INTO main.jobs SELECT * FROM live.jobs")
+    finally:
+        snapshot.execute("DETACH DATABASE live")
+
+def restore_database(zipf, sha256=None):
+    """
+    Replace the contents of the live database with the archived snapshot.
+
+    The snapshot is extracted and checked first, then copied in with the
+    SQLite online backup API in a single step, so an interrupted restore
+    leaves the previous database intact. The jobs table is not restored:
+    the live one is copied into the snapshot first.
+    """
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    tmp_path = os.path.join(BACKUP_DIR, 'fashion.db.restore')
+    extract_member(zipf, zipf.getinfo(os.path.basename(DB_PATH)), tmp_path, sha256)
+    try:
+        source = sqlite3.connect(tmp_path)
+        try:
+            if source.execute("PRAGMA integrity_check").fetchone()[0] != 'ok':
+                raise ValueError("バックアップのデータベースが破損しています。")
+            _copy_live_jobs(source)
+            target = sqlite3.connect(DB_PATH, timeout=30)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+        finally:
+            source.close()
+    finally:
+        os.remove(tmp_path)
+
+    engine = get_engine()
+    engine.dispose()
+    init_schema(engine)
+    # Image ids may now refer to different files
+    shutil.rmtree(THUMBNAIL_DIR, ignore_errors=True)
+    os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+    # The restored token may equal the one the indexes were loaded with
+    invalidate_suggestion_indexes()
+    clear_directory_snapshots()
+
+@instrumentation.timed('backup')
+def restore_backup(backup_file, progress=None):
+    """
+    Restore a backup archive in a single pass.
+
+    Upload files are streamed from the archive straight to their final
+    location by a thread pool, skipping files that are already identical.
+    Archives written by create_backup() are verified against their
+    manifest; older archives without one restore every member.
+    progress(done, total) is called as files complete.
+    Returns the numbers of restored and skipped files.
+    """
+    with zipfile.ZipFile(backup_file) as zipf:
+        names = zipf.namelist()
+        manifest = json.loads(zipf.read('manifest.json')) if 'manifest.json' in names else None
+        if manifest is not None:
+            members = [(arcname, entry['sha256']) for arcname, entry in manifest['files'].items()]
+        else:
+            special = {os.path.basename(DB_PATH), 'manifest.json'}
+            members = [(name, None) for name in dict.fromkeys(names) if name not in special and not name.endswith('/')]
+        # Validate every path before touching the disk
+        destinations = [restore_destination(arcname) for arcname, sha256 in members]
+        has_database = os.path.basename(DB_PATH) in names
+
+    total = len(members) + (1 if has_database else 0)
+    done = 0
+    restored = 0
+    lock = threading.Lock()
+    local = threading.local()
+    handles = []
+
+    def restore_file(arcname, sha256, destination):
+        # ZipFile handles are not shared between threads
+        if not hasattr(local, 'zipf'):
+            local.zipf = zipfile.ZipFile(backup_file)
+            with lock:
+                handles.append(local.zipf)
+        return extract_member(local.zipf, local.zipf.getinfo(arcname), destination, sha256)
+
+    try:
+        with ThreadPoolExecutor(max_workers=RESTORE_WORKERS) as executor:
+            futures = [
+                executor.submit(restore_file, arcname, sha256, destination)
+                for (arcname, sha256), destination in zip(members, destinations)
+            ]
+            for future in futures:
+                restored += future.result()
+                done += 1
+                if progress:
+                    progress(done, total)
+    finally:
+        for handle in handles:
+            handle.close()
+
+    if has_database:
+        with zipfile.ZipFile(backup_file) as zipf:
+            restore_database(zipf, manifest['database']['sha256'] if manifest else None)
+        if progress:
+            progress(total, total)
+    return restored, len(members) - restored
@@ -0,0 +1,364 @@
+"""
+Headless benchmark of the app's core paths on synthetic wardrobes.
+
+Every wardrobe size runs in a fresh process and a temporary working
+directory, so the measurements include the process-wide caches being
+filled and never touch the real database or uploads. Results are written
+as JSON; pass an earlier result file with --compare to print the change of
+every median.
+
+    python benchmark.py --sizes 10 100 1000 10000 --output after.json --compare before.json
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+CATEGORIES = ('top', 'bottom', 'shoes', 'accessory')
+# Upper bound on the dislike rows of the heavily disliked wardrobe
+HEAVY_DISLIKE_LIMIT = 100000
+
+def measure(function, repeat, setup=None):
+    """
+    Call function repeat times and summarize the wall-clock durations in
+    milliseconds. setup runs before every call and is not timed.
+    """
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - start) * 1000)
+    return {
+        'runs': repeat,
+        'min_ms': min(samples),
+        'median_ms': statistics.median(samples),
+        'mean_ms': statistics.fmean(samples),
+        'max_ms': max(samples),
+    }
+
+def encode_jpeg(size, color):
+    from PIL import Image as PILImage
+
+    buffer = io.BytesIO()
+    PILImage.new('RGB', size, color).save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+def random_color(rng):
+    return (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+
+def create_user(session, username):
+    from auth import SessionUser, hash_password
+    from models import User
+
+    user = User(username=username, password=hash_password('benchmark'))
+    session.add(user)
+    session.commit()
+    return SessionUser(user.id, user.username)
+
+def write_wardrobe_files(user, items, rng):
+    """
+    Write items small JPEG files into the user's upload directory.
+    """
+    from storage import UPLOAD_DIR
+
+    user_dir = os.path.join(UPLOAD_DIR, user.username)
+    os.makedirs(user_dir, exist_ok=True)
+    for number in range(items):
+        with open(os.path.join(user_dir, f'item_{number:05d}.jpg'), 'wb') as f:
+            f.write(encode_jpeg((64, 48), random_color(rng)))
+
+def assign_categories(session, user):
+    """
+    Spread the user's images evenly over the suggestion categories, the
+    way users sort the files they dropped into their directory.
+    """
+    from models import Image
+
+    ids = [image_id for (image_id,) in session.query(Image.id).filter_by(user_id=user.id).order_by(Image.id)]
+    for position, category in enumerate(CATEGORIES):
+        session.query(Image).filter(Image.id.in_(ids[position::len(CATEGORIES)])).update(
+            {Image.category: category}, synchronize_session=False
+        )
+    session.commit()
+
+def category_ids(session, user_id):
+    from models import Image
+
+    ids = {category: [] for category in CATEGORIES}
+    for image_id, category in session.query(Image.id, Image.category).filter_by(user_id=user_id).order_by(Image.id):
+        ids[category].append(image_id)
+    return ids
+
+def random_combinations(ids, count, rng):
+    combinations = set()
+    limit = 1
+    for category in CATEGORIES:
+        limit *= len(ids[category])
+    count = min(count, limit)
+    while len(combinations) < count:
+        combinations.add(tuple(rng.choice(ids[category]) for category in CATEGORIES))
+    return combinations
+
+def insert_combinations(session, model, user_id, combinations):
+    from sqlalchemy import insert
+
+    if combinations:
+        session.execute(insert(model), [
+            {'top_id': top_id, 'bottom_id': bottom_id, 'shoes_id': shoes_id,
+             'accessory_id': accessory_id, 'user_id': user_id}
+            for top_id, bottom_id, shoes_id, accessory_id in combinations
+        ])
+        session.commit()
+
+def create_heavy_user(session, source_user, heavy_fraction, rng):
+    """
+    Give a second user the same images as source_user and dislike
+    heavy_fraction of their top / bottom pairs (at most
+    HEAVY_DISLIKE_LIMIT). Returns the user and the disliked fraction.
+    """
+    from sqlalchemy import insert
+    from models import Image, Dislike
+
+    user = create_user(session, 'heavy')
+    rows = session.query(Image.category, Image.path).filter_by(user_id=source_user.id).all()
+    session.execute(insert(Image), [
+        {'category': category, 'path': path, 'user_id': user.id} for category, path in rows
+    ])
+    session.commit()
+    ids = category_ids(session, user.id)
+    tops, bottoms = ids['top'], ids['bottom']
+    space = len(tops) * len(bottoms)
+    count = min(int(space * heavy_fraction), HEAVY_DISLIKE_LIMIT)
+    insert_combinations(session, Dislike, user.id, [
+        (tops[rank // len(bottoms)], bottoms[rank % len(bottoms)], None, None)
+        for rank in rng.sample(range(space), count)
+    ])
+    return user, count / space if space else 0.0
+
+def run_size(items, options, workdir):
+    """
+    Build a wardrobe of items images for one user and time the core paths.
+    Runs in its own process with workdir as the working directory.
+    """
+    os.chdir(workdir)
+    import backup
+    import database
+    import storage
+    import suggestions
+    from models import Dislike, Favorite
+
+    rng = random.Random(options['seed'])
+    timings = {}
+    database.get_engine()
+    storage.ensure_directories()
+    session = database.Session()
+    try:
+        user = create_user(session, 'bench')
+        write_wardrobe_files(user, items, rng)
+
+        # load_images_from_directory: first scan registers every file and
+        # creates its thumbnails, a rescan diffs against the database and an
+        # unchanged directory is skipped on its mtime.
+        timings['sync_initial'] = measure(lambda: storage.sync_upload_directory(session, user), 1)
+        timings['sync_rescan'] = measure(
+            lambda: storage.sync_upload_directory(session, user), options['repeat'],
+            setup=storage.clear_directory_snapshots
+        )
+        timings['sync_unchanged'] = measure(lambda: storage.sync_upload_directory(session, user), options['repeat'])
+        assign_categories(session, user)
+
+        ids = category_ids(session, user.id)
+        feedback = max(1, int(items * options['feedback_ratio']))
+        favorites = random_combinations(ids, feedback, rng)
+        dislikes = random_combinations(ids, feedback, rng) - favorites
+        insert_combinations(session, Favorite, user.id, favorites)
+        insert_combinations(session, Dislike, user.id, dislikes)
+
+        timings['suggestion_index_load'] = measure(
+            lambda: suggestions.get_random_suggestion(user.id, True, True), options['repeat'],
+            setup=suggestions.clear_suggestion_indexes
+        )
+        timings['get_random_suggestion'] = measure(
+            lambda: suggestions.get_random_suggestion(user.id, True, True), options['repeat'] * 10
+        )
+        timings['suggest_outfits'] = measure(
+            lambda: suggestions.suggest_outfits(user.id, 6, True, True), options['repeat']
+        )
+
+        heavy_user, heavy_fraction = create_heavy_user(session, user, options['heavy_fraction'], rng)
+        timings['heavy_suggestion_index_load'] = measure(
+            lambda: suggestions.get_random_suggestion(heavy_user.id, False, False), options['repeat'],
+            setup=suggestions.clear_suggestion_indexes
+        )
+        timings['heavy_get_random_suggestion'] = measure(
+            lambda: suggestions.get_random_suggestion(heavy_user.id, False, False), options['repeat'] * 10
+        )
+
+        for name, model in (('favorites', Favorite), ('dislikes', Dislike)):
+            total = session.query(model).filter_by(user_id=user.id).count()
+            last_page = max(1, -(-total // suggestions.PAGE_SIZE))
+            timings[f'{name}_count'] = measure(
+                lambda: session.query(model).filter_by(user_id=user.id).count(), options['repeat']
+            )
+            timings[f'{name}_first_page'] = measure(
+                lambda: suggestions.load_combinations_page(session, model, user.id, 1), options['repeat'],
+                setup=session.expunge_all
+            )
+            timings[f'{name}_last_page'] = measure(
+                lambda: suggestions.load_combinations_page(session, model, user.id, last_page), options['repeat'],
+                setup=session.expunge_all
+            )
+    finally:
+        session.close()
+
+    archive = {}
+    if not options['skip_backup']:
+        timings['create_backup_full'] = measure(lambda: archive.update(path=backup.create_backup()), 1)
+        timings['create_backup_unchanged'] = measure(backup.create_backup, 1)
+        archive['bytes'] = os.path.getsize(archive['path'])
+        restore_path = os.path.join(backup.BACKUP_DIR, 'benchmark_restore.zip')
+        shutil.copy(archive['path'], restore_path)
+        timings['restore_backup_unchanged'] = measure(lambda: backup.restore_backup(restore_path), 1)
+        shutil.rmtree(os.path.join(storage.UPLOAD_DIR, user.username))
+        timings['restore_backup_missing_files'] = measure(lambda: backup.restore_backup(restore_path), 1)
+
+    return {
+        'items': items,
+        'per_category': {category: len(ids[category]) for category in CATEGORIES},
+        'favorites': len(favorites),
+        'dislikes': len(dislikes),
+        'heavy_dislike_fraction': heavy_fraction,
+        'backup_bytes': archive.get('bytes'),
+        'timings': timings,
+    }
+
+def run_upload(options, workdir):
+    """
+    Time decoding, normalizing and storing camera-sized uploads.
+    """
+    os.chdir(workdir)
+    import database
+    import storage
+
+    rng = random.Random(options['seed'])
+    database.get_engine()
+    storage.ensure_directories()
+    session = database.Session()
+    try:
+        user = create_user(session, 'upload')
+        count = options['upload_count']
+        size = tuple(options['upload_size'])
+
+        def batch():
+            return [(f'photo_{rng.random():.12f}.jpg', encode_jpeg(size, random_color(rng))) for _ in range(count)]
+
+        # The first batch includes starting the process pool
+        first, second = batch(), batch()
+        timings = {
+            'upload_cold': measure(lambda: storage.upload_images(session, user, first, 'top'), 1),
+            'upload_warm': measure(lambda: storage.upload_images(session, user, second, 'top'), 1),
+            # Already uploaded bytes are rejected before decoding
+            'upload_duplicates': measure(lambda: storage.upload_images(session, user, second, 'top'), 1),
+        }
+    finally:
+        session.close()
+        storage.shutdown_upload_executor()
+    return {
+        'images': count,
+        'size': list(size),
+        'per_image_warm_ms': timings['upload_warm']['median_ms'] / count,
+        'timings': timings,
+    }
+
+def run_isolated(function, *args):
+    # A fresh process per run: module-level caches and the engine start cold
+    workdir = tempfile.mkdtemp(prefix='cordinate-bench-')
+    try:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            return executor.submit(function, *args, workdir).result()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def compare(results, baseline):
+    """
+    Print the ratio of every median to the baseline's, slower first.
+    """
+    def medians(report):
+        values = {}
+        for entry in report['sizes']:
+            for name, timing in entry['timings'].items():
+                values[(entry['items'], name)] = timing['median_ms']
+        if report.get('upload'):
+            for name, timing in report['upload']['timings'].items():
+                values[('upload', name)] = timing['median_ms']
+        return values
+
+    current, previous = medians(results), medians(baseline)
+    rows = [
+        (current[key] / previous[key] if previous[key] else float('inf'), key)
+        for key in current if key in previous
+    ]
+    for ratio, (items, name) in sorted(rows, key=lambda row: row[0], reverse=True):
+        print(f'{str(items):>7} {name:<32} {previous[(items, name)]:10.2f} ms -> '
+              f'{current[(items, name)]:10.2f} ms  x{ratio:.2f}', file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='wardrobe sizes (images per user, spread over the four categories)')
+    parser.add_argument('--repeat', type=int, default=20, help='runs of every fast measurement')
+    parser.add_argument('--feedback-ratio', type=float, default=0.1,
+                        help='favorites and dislikes per image of the wardrobe')
+    parser.add_argument('--heavy-fraction', type=float, default=0.9,
+                        help='share of top / bottom pairs disliked by the heavily disliked user')
+    parser.add_argument('--upload-count', type=int, default=8, help='images per upload batch')
+    parser.add_argument('--upload-size', type=int, nargs=2, default=[4000, 3000], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--skip-backup', action='store_true', help='do not time create_backup / restore_backup')
+    parser.add_argument('--skip-upload', action='store_true', help='do not time image uploads')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON result file (default: stdout)')
+    parser.add_argument('--compare', metavar='BASELINE', help='earlier JSON result to compare against')
+    args = parser.parse_args(argv)
+    options = vars(args)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'options': {key: value for key, value in options.items() if key not in ('output', 'compare')},
+        'sizes': [],
+        'upload': None,
+    }
+    for items in args.sizes:
+        print(f'benchmarking {items} items...', file=sys.stderr)
+        results['sizes'].append(run_isolated(run_size, items, options))
+    if not args.skip_upload:
+        print('benchmarking uploads...', file=sys.stderr)
+        results['upload'] = run_isolated(run_upload, options)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -1,74 +1,54 @@
-import bcrypt
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey
-from sqlalchemy.orm import sessionmaker, relationship, declarative_base
-from sqlalchemy.exc import IntegrityError, OperationalError
-import streamlit as st
-from PIL import Image as PILImage
-import pillow_heif
 import os
-import random
 import sys
-import shutil
-import zipfile
-import imageio.v3 as iio  # imageio の v3 を使用
-import io
+import time
+import uuid
+
+import streamlit as st
+from sqlalchemy.exc import IntegrityError
+
+import instrumentation
+import jobs
+from auth import TooManyAttempts, authenticate, register
+from backup import BACKUP_DIR
+from database import Session, get_engine
+from models import Dislike, Favorite
+from storage import (
+    GALLERY_PAGE_SIZE, count_gallery_images, delete_images, directory_changed, ensure_directories,
+    get_collage, get_thumbnail, load_gallery_page,
+)
+from suggestions import (
+    PAGE_SIZE, SUGGESTION_CATEGORIES, get_random_suggestion, get_suggestion_index,
+    load_combinations_page, record_feedback, remove_feedback, suggest_outfits,
+)
 
 # Increase recursion limit
 sys.setrecursionlimit(5000)
 
-# Set up database
-Base = declarative_base()
-
-class User(Base):
-    __tablename__ = 'users'
-    id = Column(Integer, primary_key=True)
-    username = Column(String, unique=True, nullable=False)
-    password = Column(String, nullable=False)
-    images = relationship('Image', back_populates='user')
-    dislikes = relationship('Dislike', back_populates='user')
-    favorites = relationship('Favorite', back_populates='user')
-
-class Image(Base):
-    __tablename__ = 'images'
-    id = Column(Integer, primary_key=True)
-    category = Column(String)
-    path = Column(String)
-    user_id = Column(Integer, ForeignKey('users.id'))
-    user = relationship('User', back_populates='images')
-
-class Dislike(Base):
-    __tablename__ = 'dislikes'
-    id = Column(Integer, primary_key=True)
-    top_id = Column(Integer, ForeignKey('images.id'))
-    bottom_id = Column(Integer, ForeignKey('images.id'))
-    shoes_id = Column(Integer, ForeignKey('images.id'), nullable=True)
-    accessory_id = Column(Integer, ForeignKey('images.id'), nullable=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
-    user = relationship('User', back_populates='dislikes')
-
-class Favorite(Base):
-    __tablename__ = 'favorites'
-    id = Column(Integer, primary_key=True)
-    top_id = Column(Integer, ForeignKey('images.id'))
-    bottom_id = Column(Integer, ForeignKey('images.id'))
-    shoes_id = Column(Integer, ForeignKey('images.id'), nullable=True)
-    accessory_id = Column(Integer, ForeignKey('images.id'), nullable=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
-    user = relationship('User', back_populates='favorites')
-
-# Create database
-engine = create_engine('sqlite:///fashion.db')
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
-session = Session()
-
-# Directory for uploaded images and backups
-UPLOAD_DIR = 'uploads'
-BACKUP_DIR = 'backups'
-if not os.path.exists(UPLOAD_DIR):
-    os.makedirs(UPLOAD_DIR)
-if not os.path.exists(BACKUP_DIR):
-    os.makedirs(BACKUP_DIR)
+# Upload page gallery grid
+GALLERY_COLUMNS = 4
+
+JOB_LABELS = {
+    'import': 'アップロード', 'import_files': 'フォルダの取り込み', 'thumbnails': 'サムネイルの再生成', 'sync': 'フォルダの同期',
+    'backup': 'バックアップ', 'restore': 'バックアップの復元',
+}
+JOB_STATUS_LABELS = {
+    'queued': '待機中', 'running': '実行中', 'succeeded': '完了', 'failed': '失敗',
+    'cancelled': 'キャンセル', 'interrupted': '中断',
+}
+
+@st.cache_resource
+def initialize():
+    """
+    Create the directories, the engine and the schema once per process;
+    every later rerun only pays for the cache lookup.
+    """
+    ensure_directories()
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    engine = get_engine()
+    jobs.start_workers()
+    return engine
+
+initialize()
 
 # Initialize session state for buttons
 if "dislike_button_clicked" not in st.session_state:
@@ -80,419 +60,414 @@ if "favorite_button_clicked" not in st.session_state:
 if "logged_in_user" not in st.session_state:
     st.session_state["logged_in_user"] = None
 
-def hash_password(password):
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-
-def check_password(hashed_password, plain_password):
-    return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
-
-def authenticate(username, password):
-    user = session.query(User).filter_by(username=username).first()
-    if user and check_password(user.password, password):
-        return user
-    return None
-
-def register(username, password):
-    hashed_password = hash_password(password)
-    new_user = User(username=username, password=hashed_password)
-    try:
-        session.add(new_user)
-        session.commit()
-        return new_user
-    except IntegrityError:
-        session.rollback()
-        return None
-
-def create_backup():
-    backup_file = os.path.join(BACKUP_DIR, 'fashion_backup.zip')
-    with zipfile.ZipFile(backup_file, 'w') as zipf:
-        # Add database file to the zip
-        zipf.write('fashion.db', os.path.basename('fashion.db'))
-        # Add user-specific uploaded images to the zip
-        for root, dirs, files in os.walk(UPLOAD_DIR):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, UPLOAD_DIR)
-                zipf.write(file_path, arcname)
-    return backup_file
-
-def restore_backup(backup_file):
-    with zipfile.ZipFile(backup_file, 'r') as zipf:
-        # Extract all files in the ZIP to a temporary directory
-        temp_dir = os.path.join(BACKUP_DIR, 'temp_restore')
-        zipf.extractall(temp_dir)
-        
-        # Print the contents of the temporary directory for debugging
-        for root, dirs, files in os.walk(temp_dir):
-            print("Root:", root)
-            print("Directories:", dirs)
-            print("Files:", files)
-        
-        # Move the extracted database file to the current directory
-        db_path = os.path.join(temp_dir, 'fashion.db')
-        if os.path.exists(db_path):
-            shutil.move(db_path, 'fashion.db')
-
-        # Process the extracted uploads directory
-        for user_dir in os.listdir(temp_dir):
-            user_dir_path = os.path.join(temp_dir, user_dir)
-            if os.path.isdir(user_dir_path) and user_dir != 'fashion.db':
-                user_upload_dir = os.path.join(UPLOAD_DIR, user_dir)
-                if not os.path.exists(user_upload_dir):
-                    os.makedirs(user_upload_dir)
-                for root, dirs, files in os.walk(user_dir_path):
-                    for file_ in files:
-                        # Source file path
-                        src_file = os.path.join(root, file_)
-                        # Relative path from the extracted user directory
-                        relative_path = os.path.relpath(src_file, user_dir_path)
-                        # Destination file path
-                        dst_file = os.path.join(user_upload_dir, relative_path)
-                        # Create the destination directory if it doesn't exist
-                        dst_dir = os.path.dirname(dst_file)
-                        if not os.path.exists(dst_dir):
-                            os.makedirs(dst_dir)
-                        # Copy the file
-                        shutil.copy2(src_file, dst_file)
-
-        # Clean up the temporary directory
-        shutil.rmtree(temp_dir)
-
-def hash_existing_passwords():
-    users = session.query(User).all()
-    for user in users:
-        if not user.password.startswith('$2b$'):
-            hashed_password = hash_password(user.password)
-            user.password = hashed_password
-    session.commit()
-
-# Hash existing passwords
-hash_existing_passwords()
-
-# Streamlit app
-st.title('ファッション提案アプリ')
-
-if st.session_state["logged_in_user"] is None:
-    st.header("ログイン")
-    username = st.text_input("ユーザー名")
-    password = st.text_input("パスワード", type="password")
-    if st.button("ログイン"):
-        user = authenticate(username, password)
-        if user:
-            st.session_state["logged_in_user"] = user
-            st.success("ログイン成功")
+def show_active_jobs(user_id, kinds=None):
+    """
+    Progress of the user's queued and running jobs, refreshed every second
+    until they have all finished.
+    """
+    if not jobs.active_jobs(user_id, kinds):
+        return
+
+    @st.fragment(run_every=1.0)
+    def job_progress():
+        active = jobs.active_jobs(user_id, kinds)
+        if not active:
+            # Rerun the whole page so that it shows the results
             st.rerun()
-        else:
-            st.error("ログイン失敗")
+        for job in active:
+            st.progress(
+                job.done / job.total if job.total else 0.0,
+                text=f"{JOB_LABELS.get(job.kind, job.kind)}: {JOB_STATUS_LABELS[job.status]} {job.done}/{job.total}"
+            )
+
+    job_progress()
+
+def pop_finished_job(key):
+    """
+    Return the job whose id is kept under key in the session state once it
+    has finished, and forget it.
+    """
+    job_id = st.session_state.get(key)
+    if job_id is None:
+        return None
+    job = jobs.get_job(job_id)
+    if job is not None and job.status not in jobs.FINISHED_STATUSES:
+        return None
+    del st.session_state[key]
+    return job
+
+def show_debug_panel(metrics):
+    """
+    Per-rerun breakdown of SQL and stage timings in the sidebar.
+    """
+    with st.sidebar.expander('デバッグ情報', expanded=True):
+        st.write(f"再実行: {metrics.duration * 1000:.1f} ms")
+        st.write(f"SQL: {len(metrics.queries)} 件, {metrics.query_seconds() * 1000:.1f} ms")
+        rows = [
+            {'ステージ': name, '回数': calls, 'ms': round(seconds * 1000, 1)}
+            for name, (calls, seconds) in sorted(metrics.stages.items(), key=lambda item: -item[1][1])
+        ]
+        rows.append({'ステージ': 'その他 (描画など)', '回数': 1, 'ms': round(metrics.unattributed_seconds() * 1000, 1)})
+        st.dataframe(rows, hide_index=True)
+        for statement, count in metrics.repeated_statements():
+            st.warning(f"同じクエリが {count} 回実行されました (N+1 の可能性)")
+            st.code(statement, language='sql')
+        for key, value in metrics.notes.items():
+            st.write(f"{key}: {value}")
+
+# Instrumentation is opt-in: CORDINATE_DEBUG=1, ?debug=1 or a metrics export
+show_debug = instrumentation.DEBUG or st.query_params.get('debug') == '1'
+metrics = None
+if show_debug or instrumentation.collection_enabled():
+    metrics = instrumentation.start_rerun(st.session_state.get('page', ''))
+
+# One short-lived database session per script run
+session = Session()
+try:
+    # Streamlit app
+    st.title('ファッション提案アプリ')
+
+    if st.session_state["logged_in_user"] is None:
+        st.header("ログイン")
+        username = st.text_input("ユーザー名")
+        password = st.text_input("パスワード", type="password")
+        if st.button("ログイン"):
+            try:
+                user = authenticate(session, username, password)
+                if user:
+                    st.session_state["logged_in_user"] = user
+                    st.success("ログイン成功")
+                    st.rerun()
+                else:
+                    st.error("ログイン失敗")
+            except TooManyAttempts:
+                st.error("試行回数が多すぎます。しばらくしてから再度お試しください。")
     
-    st.header("新規登録")
-    new_username = st.text_input("新しいユーザー名")
-    new_password = st.text_input("新しいパスワード", type="password")
-    if st.button("登録"):
-        new_user = register(new_username, new_password)
-        if new_user:
-            st.success("登録成功")
-        else:
-            st.error("ユーザー名は既に存在します")
-else:
-    user = st.session_state["logged_in_user"]
-    st.sidebar.text(f"ログイン中: {user.username}")
-    if st.sidebar.button("ログアウト"):
-        st.session_state["logged_in_user"] = None
-        st.rerun()
-
-    # Page navigation
-    page = st.sidebar.selectbox('ページを選択', ['画像をアップロード', 'コーディネート提案', 'お気に入りの編集', '嫌いな組み合わせの編集', 'データベースバックアップ'])
-
-    def load_images_from_directory():
-        """
-        Load images from the upload directory into the database if not already present.
-        """
-        user_upload_dir = os.path.join(UPLOAD_DIR, user.username)
-        if not os.path.exists(user_upload_dir):
-            os.makedirs(user_upload_dir)
-        
-        for file_name in os.listdir(user_upload_dir):
-            file_path = os.path.join(user_upload_dir, file_name)
-            if not session.query(Image).filter_by(path=file_path, user_id=user.id).first():
-                category = '未分類'  # Default category if not assigned
-                new_image = Image(category=category.lower(), path=file_path, user_id=user.id)
-                session.add(new_image)
-        session.commit()
-
-    def check_dislike_exists(top_id, bottom_id, shoes_id, accessory_id):
-        return session.query(Dislike).filter_by(
-            top_id=top_id, bottom_id=bottom_id, shoes_id=shoes_id, accessory_id=accessory_id, user_id=user.id
-        ).first() is not None
-
-    def check_favorite_exists(top_id, bottom_id, shoes_id, accessory_id):
-        return session.query(Favorite).filter_by(
-            top_id=top_id, bottom_id=bottom_id, shoes_id=shoes_id, accessory_id=accessory_id, user_id=user.id
-        ).first() is not None
-
-    if page == '画像をアップロード':
-        # Image upload
-        st.header('画像をアップロード')
-        category = st.selectbox('カテゴリー', ['top', 'bottom', 'shoes', 'accessory'])
-        uploaded_file = st.file_uploader("画像を選択...", type=["jpg", "png", "jpeg", "heic"])
-
-        if uploaded_file is not None:
+        st.header("新規登録")
+        new_username = st.text_input("新しいユーザー名")
+        new_password = st.text_input("新しいパスワード", type="password")
+        if st.button("登録"):
             try:
-                # Display the uploaded file information
-                st.write(f"アップロードされたファイル: {uploaded_file.name}")
-                # HEICサポートを追加
-                pillow_heif.register_heif_opener()
-
-                file_name = uploaded_file.name.lower()
-
-                # ファイルがHEIC形式であるかどうかをチェック
-                if file_name.endswith('.heic'):
-                    # ファイルをバイナリモードで読み取り、BytesIOオブジェクトに変換
-                    uploaded_file_bytes = uploaded_file.read()
-                    byte_stream = io.BytesIO(uploaded_file_bytes)
-                    img = PILImage.open(byte_stream)
+                new_user = register(session, new_username, new_password)
+                if new_user:
+                    st.success("登録成功")
                 else:
-                    # 他の形式の場合もバイナリモードで読み取り、BytesIOオブジェクトに変換
-                    uploaded_file_bytes = uploaded_file.read()
-                    byte_stream = io.BytesIO(uploaded_file_bytes)
-                    img = PILImage.open(byte_stream)
-                user_upload_dir = os.path.join(UPLOAD_DIR, user.username)
-                if not os.path.exists(user_upload_dir):
-                    os.makedirs(user_upload_dir)
-
-                file_path = os.path.join(user_upload_dir, uploaded_file.name)
-
-                # Save the uploaded file to the server
-                img.save(file_path)
-                new_image = Image(category=category.lower(), path=file_path, user_id=user.id)
-                session.add(new_image)
-                session.commit()
-                st.success(f"{uploaded_file.name} を {category} カテゴリーにアップロードしました。")
-            except Exception as e:
-                st.error(f"ファイルのアップロードエラー: {e}")
-                st.error(f"デバッグ情報: {uploaded_file}, {file_path}")
-
-        # Uploaded images
-        st.header('アップロードされた画像')
-        try:
-            images = session.query(Image).filter_by(user_id=user.id).all()
-            st.write(f"デバッグ情報: 画像の数: {len(images)}")
-        except Exception as e:
-            st.error(f"データベースクエリエラー: {e}")
-
-        for image in images:
+                    st.error("ユーザー名は既に存在します")
+            except TooManyAttempts:
+                st.error("試行回数が多すぎます。しばらくしてから再度お試しください。")
+    else:
+        user = st.session_state["logged_in_user"]
+        st.sidebar.text(f"ログイン中: {user.username}")
+        if st.sidebar.button("ログアウト"):
+            st.session_state["logged_in_user"] = None
+            st.rerun()
+
+        # Page navigation
+        page = st.sidebar.selectbox('ページを選択', ['画像をアップロード', 'コーディネート提案', 'お気に入りの編集', '嫌いな組み合わせの編集', 'データベースバックアップ', 'ジョブ'], key='page')
+
+        def load_images_from_directory():
+            """
+            Queue a sync of the upload directory into the database when it
+            changed since the last scan.
+            """
+            if directory_changed(user):
+                jobs.submit('sync', {'username': user.username}, user.id, unique=True)
+
+        # Load images from directory into the database (if not already present)
+        load_images_from_directory()
+
+        def select_page(total, key, page_size=PAGE_SIZE):
+            page_count = max(1, -(-total // page_size))
+            if st.session_state.get(key, 1) > page_count:
+                st.session_state[key] = page_count
+            return st.number_input(f'ページ (全 {page_count} ページ)', min_value=1, max_value=page_count, key=key)
+
+        if page == '画像をアップロード':
+            # Image upload
+            st.header('画像をアップロード')
+            category = st.selectbox('カテゴリー', ['top', 'bottom', 'shoes', 'accessory'])
+            if "uploader_key" not in st.session_state:
+                st.session_state["uploader_key"] = 0
+            uploaded_files = st.file_uploader(
+                "画像を選択...", type=["jpg", "png", "jpeg", "heic"], accept_multiple_files=True,
+                key=f'uploader_{st.session_state["uploader_key"]}'
+            )
+
+            if uploaded_files and st.button(f'{len(uploaded_files)} 枚をアップロード'):
+                try:
+                    st.session_state["import_job"] = jobs.submit_import(
+                        user, [(uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in uploaded_files], category
+                    )
+                    # Clear the selection so the files are not uploaded again
+                    st.session_state["uploader_key"] += 1
+                    st.rerun()
+                except OSError as e:
+                    st.error(f"ファイルのアップロードエラー: {e}")
+
+            import_job = pop_finished_job("import_job")
+            if import_job is not None:
+                result = jobs.result_of(import_job)
+                if import_job.status == 'succeeded':
+                    if result['added']:
+                        st.success(f"{result['added']} 枚の画像をアップロードしました。")
+                    for file_name, error in result['errors']:
+                        st.error(f"{file_name}: {error}")
+                elif import_job.status == 'failed':
+                    st.error(f"ファイルのアップロードエラー: {import_job.error}")
+
+            # Uploaded images
+            st.header('アップロードされた画像')
+            if st.button('サムネイルを再生成'):
+                st.session_state["thumbnail_job"] = jobs.submit('thumbnails', {'force': True}, user.id, unique=True)
+            thumbnail_job = pop_finished_job("thumbnail_job")
+            if thumbnail_job is not None and thumbnail_job.status == 'succeeded':
+                result = jobs.result_of(thumbnail_job)
+                st.success(f"{result['generated']} 件のサムネイルを再生成しました。")
+                if result['failed']:
+                    st.error(f"{result['failed']} 件のサムネイルを生成できませんでした。")
+            show_active_jobs(user.id, ['import', 'thumbnails', 'sync'])
+            gallery_category = st.selectbox('表示するカテゴリー', ['すべて', 'top', 'bottom', 'shoes', 'accessory', '未分類'])
+            images = []
             try:
-                st.image(image.path, caption=f"{image.category} (ID: {image.id})", width=150)
+                category_filter = None if gallery_category == 'すべて' else gallery_category
+                total = count_gallery_images(session, user.id, category_filter)
+                instrumentation.note('画像の数', total)
+                page_number = select_page(total, 'gallery_page', GALLERY_PAGE_SIZE)
+                images = load_gallery_page(session, user.id, category_filter, page_number)
             except Exception as e:
-                st.error(f"画像の読み込みエラー: {e}")
+                st.error(f"データベースクエリエラー: {e}")
+
+            with st.form('gallery'):
+                for row_start in range(0, len(images), GALLERY_COLUMNS):
+                    columns = st.columns(GALLERY_COLUMNS)
+                    for column, (image_id, image_category, image_path) in zip(columns, images[row_start:row_start + GALLERY_COLUMNS]):
+                        with column:
+                            try:
+                                st.image(get_thumbnail(image_id, image_path), caption=f"{image_category} (ID: {image_id})", width=150)
+                            except Exception as e:
+                                st.error(f"画像の読み込みエラー: {e}")
+                            st.checkbox('選択', key=f'select_{image_id}')
+                delete_clicked = st.form_submit_button('選択した画像を削除')
+
+            if delete_clicked:
+                selected = [image_id for image_id, _, _ in images if st.session_state.get(f'select_{image_id}')]
+                if selected:
+                    try:
+                        deleted = delete_images(session, user, selected)
+                        st.success(f"{deleted} 枚の画像を削除しました")
+                        st.rerun()
+                    except Exception as e:
+                        session.rollback()
+                        st.error(f"画像の削除エラー: {e}")
+
+        elif page == 'コーディネート提案':
+            # Random suggestion
+            st.header('ランダムなコーディネート提案')
 
-            if st.button(f'削除 {image.id}', key=f'delete_{image.id}'):
+            include_shoes = st.checkbox('shoesを含む', value=True)
+            include_accessory = st.checkbox('accessoryを含む', value=True)
+
+            if st.button('コーディネート提案'):
+                st.session_state["suggestion"] = get_random_suggestion(user.id, include_shoes, include_accessory)
+
+            suggestion = st.session_state.get("suggestion")
+            paths = get_suggestion_index(user.id).paths
+            if suggestion and all(image_id in paths for image_id in suggestion if image_id is not None):
+                caption = ' / '.join(
+                    category for category, image_id in zip(SUGGESTION_CATEGORIES, suggestion) if image_id is not None
+                )
                 try:
-                    if os.path.exists(image.path):
-                        os.remove(image.path)
-                    session.delete(image)
-                    session.commit()
-                    st.success(f"画像 {image.id} を削除しました")
-                    st.rerun()
+                    st.image(get_collage(suggestion, paths), caption=caption)
                 except Exception as e:
-                    st.error(f"画像の削除エラー: {e}")
-
-    elif page == 'コーディネート提案':
-        # Random suggestion
-        st.header('ランダムなコーディネート提案')
-
-        def get_images_by_category(category):
-            return session.query(Image).filter_by(category=category.lower(), user_id=user.id).all()
-
-        def get_random_image(category):
-            images = get_images_by_category(category)
-            if images:
-                return random.choice(images)
-            return None
-
-        def is_disliked_combination(top, bottom, shoes, accessory):
-            if top and bottom:
-                dislike = session.query(Dislike).filter_by(
-                    top_id=top.id, bottom_id=bottom.id, shoes_id=shoes.id if shoes else None, accessory_id=accessory.id if accessory else None, user_id=user.id
-                ).first()
-                return dislike is not None
-            return False
-
-        def get_random_suggestion(include_shoes, include_accessory):
-            attempts = 0
-            max_attempts = 10
-            while attempts < max_attempts:
-                top = get_random_image('top')
-                bottom = get_random_image('bottom')
-                shoes = get_random_image('shoes') if include_shoes else None
-                accessory = get_random_image('accessory') if include_accessory else None
-                if top and bottom and not is_disliked_combination(top, bottom, shoes, accessory):
-                    return top, bottom, shoes, accessory
-                attempts += 1
-            return None, None, None, None
-
-        include_shoes = st.checkbox('shoesを含む', value=True)
-        include_accessory = st.checkbox('accessoryを含む', value=True)
-
-        if st.button('コーディネート提案'):
-            top, bottom, shoes, accessory = get_random_suggestion(include_shoes, include_accessory)
-            st.session_state["top"] = top
-            st.session_state["bottom"] = bottom
-            st.session_state["shoes"] = shoes
-            st.session_state["accessory"] = accessory
-
-        if "top" in st.session_state and st.session_state["top"] and st.session_state["bottom"]:
-            st.subheader('top')
-            st.image(st.session_state["top"].path, width=150)
-            st.subheader('bottom')
-            st.image(st.session_state["bottom"].path, width=150)
-            if st.session_state["shoes"]:
-                st.subheader('shoes')
-                st.image(st.session_state["shoes"].path, width=150)
-            if st.session_state["accessory"]:
-                st.subheader('accessory')
-                st.image(st.session_state["accessory"].path, width=150)
-        else:
-            st.error("新しい提案を生成できませんでした。もっと画像をアップロードするか、嫌いな組み合わせを調整してください。")
-
-        # Feedback
-        st.header('フィードバック')
-        if st.button('この組み合わせは嫌い'):
-            st.session_state["dislike_button_clicked"] = True
-
-        if st.session_state["dislike_button_clicked"]:
-            if st.session_state["top"] and st.session_state["bottom"]:
-                if not check_dislike_exists(
-                    st.session_state["top"].id, st.session_state["bottom"].id,
-                    st.session_state["shoes"].id if st.session_state["shoes"] else None,
-                    st.session_state["accessory"].id if st.session_state["accessory"] else None
-                ):
+                    st.error(f"画像の読み込みエラー: {e}")
+            else:
+                suggestion = None
+                st.error("新しい提案を生成できませんでした。もっと画像をアップロードするか、嫌いな組み合わせを調整してください。")
+
+            # Feedback
+            st.header('フィードバック')
+            if st.button('この組み合わせは嫌い'):
+                st.session_state["dislike_button_clicked"] = True
+
+            if st.session_state["dislike_button_clicked"]:
+                if suggestion:
                     try:
-                        new_dislike = Dislike(
-                            top_id=st.session_state["top"].id, 
-                            bottom_id=st.session_state["bottom"].id, 
-                            shoes_id=st.session_state["shoes"].id if st.session_state["shoes"] else None, 
-                            accessory_id=st.session_state["accessory"].id if st.session_state["accessory"] else None,
-                            user_id=user.id
-                        )
-                        session.add(new_dislike)
-                        session.commit()
+                        record_feedback(session, Dislike, user.id, suggestion)
                         st.success("組み合わせが嫌いとして記録されました。今後この組み合わせは提案されません。")
                         st.session_state["dislike_button_clicked"] = False
                         st.rerun()
+                    except IntegrityError:
+                        session.rollback()
+                        st.error("この組み合わせは既に嫌いな組み合わせとして登録されています。")
                     except Exception as e:
+                        session.rollback()
                         st.error(f"嫌いな組み合わせの保存エラー: {e}")
-                else:
-                    st.error("この組み合わせは既に嫌いな組み合わせとして登録されています。")
-
-        if st.button('この組み合わせは好き'):
-            st.session_state["favorite_button_clicked"] = True
-
-        if st.session_state["favorite_button_clicked"]:
-            if st.session_state["top"] and st.session_state["bottom"]:
-                if not check_favorite_exists(
-                    st.session_state["top"].id, st.session_state["bottom"].id,
-                    st.session_state["shoes"].id if st.session_state["shoes"] else None,
-                    st.session_state["accessory"].id if st.session_state["accessory"] else None
-                ):
+
+            if st.button('この組み合わせは好き'):
+                st.session_state["favorite_button_clicked"] = True
+
+            if st.session_state["favorite_button_clicked"]:
+                if suggestion:
                     try:
-                        new_favorite = Favorite(
-                            top_id=st.session_state["top"].id, 
-                            bottom_id=st.session_state["bottom"].id, 
-                            shoes_id=st.session_state["shoes"].id if st.session_state["shoes"] else None, 
-                            accessory_id=st.session_state["accessory"].id if st.session_state["accessory"] else None,
-                            user_id=user.id
-                        )
-                        session.add(new_favorite)
-                        session.commit()
+                        record_feedback(session, Favorite, user.id, suggestion)
                         st.success("組み合わせが好きとして記録されました。")
                         st.session_state["favorite_button_clicked"] = False
+                    except IntegrityError:
+                        session.rollback()
+                        st.error("この組み合わせは既に好きな組み合わせとして登録されています。")
                     except Exception as e:
+                        session.rollback()
                         st.error(f"好きな組み合わせの保存エラー: {e}")
-                else:
-                    st.error("この組み合わせは既に好きな組み合わせとして登録されています。")
-
-    elif page == '嫌いな組み合わせの編集':
-        st.header('嫌いな組み合わせ')
-        try:
-            disliked_combinations = session.query(Dislike).filter_by(user_id=user.id).all()
-            st.write(f"デバッグ情報: 嫌いな組み合わせの数: {len(disliked_combinations)}")
-        except Exception as e:
-            st.error(f"データベースクエリエラー: {e}")
-
-        for dislike in disliked_combinations:
-            top_img = session.query(Image).filter_by(id=dislike.top_id).first()
-            bottom_img = session.query(Image).filter_by(id=dislike.bottom_id).first()
-            shoes_img = session.query(Image).filter_by(id=dislike.shoes_id).first() if dislike.shoes_id else None
-            accessory_img = session.query(Image).filter_by(id=dislike.accessory_id).first() if dislike.accessory_id else None
-
-            st.write("嫌いな組み合わせ:")
+
+            # Batch suggestions
+            st.header('まとめて提案')
+            outfit_count = st.number_input('提案数', min_value=1, max_value=30, value=6)
+            if st.button('まとめて提案'):
+                st.session_state["outfits"] = suggest_outfits(user.id, outfit_count, include_shoes, include_accessory)
+
+            outfits = [
+                outfit for outfit in st.session_state.get("outfits", [])
+                if all(image_id in paths for image_id in outfit if image_id is not None)
+            ]
+            for row_start in range(0, len(outfits), 3):
+                columns = st.columns(3)
+                for column, outfit in zip(columns, outfits[row_start:row_start + 3]):
+                    with column:
+                        try:
+                            st.image(get_collage(outfit, paths))
+                        except Exception as e:
+                            st.error(f"画像の読み込みエラー: {e}")
+        elif page == '嫌いな組み合わせの編集':
+            st.header('嫌いな組み合わせ')
+            disliked_combinations = []
             try:
-                st.image(top_img.path if top_img else '', caption='top', width=150)
-                st.image(bottom_img.path if bottom_img else '', caption='bottom', width=150)
-                if shoes_img:
-                    st.image(shoes_img.path, caption='shoes', width=150)
-                if accessory_img:
-                    st.image(accessory_img.path, caption='accessory', width=150)
+                total = session.query(Dislike).filter_by(user_id=user.id).count()
+                instrumentation.note('嫌いな組み合わせの数', total)
+                page_number = select_page(total, 'dislike_page')
+                disliked_combinations = load_combinations_page(session, Dislike, user.id, page_number)
             except Exception as e:
-                st.error(f"画像の読み込みエラー: {e}")
+                st.error(f"データベースクエリエラー: {e}")
 
-            if st.button(f'嫌いを解除 {dislike.id}', key=f'remove_{dislike.id}'):
-                session.delete(dislike)
-                session.commit()
-                st.success(f'嫌い {dislike.id} を解除しました')
-                st.rerun()
+            for dislike in disliked_combinations:
+                members = [dislike.top, dislike.bottom, dislike.shoes, dislike.accessory]
+                combination = (dislike.top_id, dislike.bottom_id, dislike.shoes_id, dislike.accessory_id)
+
+                st.write("嫌いな組み合わせ:")
+                try:
+                    st.image(
+                        get_collage(combination, {image.id: image.path for image in members if image}),
+                        caption=' / '.join(
+                            category for category, image in zip(SUGGESTION_CATEGORIES, members) if image
+                        )
+                    )
+                except Exception as e:
+                    st.error(f"画像の読み込みエラー: {e}")
 
-    elif page == 'お気に入りの編集':
-        st.header('好きな組み合わせ')
-        try:
-            favorite_combinations = session.query(Favorite).filter_by(user_id=user.id).all()
-            st.write(f"デバッグ情報: 好きな組み合わせの数: {len(favorite_combinations)}")
-        except Exception as e:
-            st.error(f"データベースクエリエラー: {e}")
-
-        for favorite in favorite_combinations:
-            top_img = session.query(Image).filter_by(id=favorite.top_id).first()
-            bottom_img = session.query(Image).filter_by(id=favorite.bottom_id).first()
-            shoes_img = session.query(Image).filter_by(id=favorite.shoes_id).first() if favorite.shoes_id else None
-            accessory_img = session.query(Image).filter_by(id=favorite.accessory_id).first() if favorite.accessory_id else None
-
-            st.write("好きな組み合わせ:")
+                if st.button(f'嫌いを解除 {dislike.id}', key=f'remove_{dislike.id}'):
+                    remove_feedback(session, dislike)
+                    st.success(f'嫌い {dislike.id} を解除しました')
+                    st.rerun()
+
+        elif page == 'お気に入りの編集':
+            st.header('好きな組み合わせ')
+            favorite_combinations = []
             try:
-                st.image(top_img.path if top_img else '', caption='top', width=150)
-                st.image(bottom_img.path if bottom_img else '', caption='bottom', width=150)
-                if shoes_img:
-                    st.image(shoes_img.path, caption='shoes', width=150)
-                if accessory_img:
-                    st.image(accessory_img.path, caption='accessory', width=150)
+                total = session.query(Favorite).filter_by(user_id=user.id).count()
+                instrumentation.note('好きな組み合わせの数', total)
+                page_number = select_page(total, 'favorite_page')
+                favorite_combinations = load_combinations_page(session, Favorite, user.id, page_number)
             except Exception as e:
-                st.error(f"画像の読み込みエラー: {e}")
+                st.error(f"データベースクエリエラー: {e}")
+
+            for favorite in favorite_combinations:
+                members = [favorite.top, favorite.bottom, favorite.shoes, favorite.accessory]
+                combination = (favorite.top_id, favorite.bottom_id, favorite.shoes_id, favorite.accessory_id)
+
+                st.write("好きな組み合わせ:")
+                try:
+                    st.image(
+                        get_collage(combination, {image.id: image.path for image in members if image}),
+                        caption=' / '.join(
+                            category for category, image in zip(SUGGESTION_CATEGORIES, members) if image
+                        )
+                    )
+                except Exception as e:
+                    st.error(f"画像の読み込みエラー: {e}")
+
+                if st.button(f'好きから解除 {favorite.id}', key=f'remove_fav_{favorite.id}'):
+                    remove_feedback(session, favorite)
+                    st.success(f'好き {favorite.id} を解除しました')
+                    st.rerun()
 
-            if st.button(f'好きから解除 {favorite.id}', key=f'remove_fav_{favorite.id}'):
-                session.delete(favorite)
-                session.commit()
-                st.success(f'好き {favorite.id} を解除しました')
+        elif page == 'データベースバックアップ':
+            st.header('データベースバックアップ')
+            backup_job = jobs.latest_job('backup', user.id)
+            backup_running = backup_job is not None and backup_job.status in jobs.ACTIVE_STATUSES
+            if st.button('バックアップを作成', disabled=backup_running):
+                jobs.submit('backup', user_id=user.id)
                 st.rerun()
 
-    elif page == 'データベースバックアップ':
-        st.header('データベースバックアップ')
-        if st.button('バックアップを作成'):
-            backup_file = create_backup()
-            st.success("バックアップが作成されました。")
-            with open(backup_file, 'rb') as f:
-                st.download_button(label="バックアップをダウンロード", data=f, file_name='fashion_backup.zip')
-
-        st.header('バックアップの復元')
-        uploaded_backup = st.file_uploader("バックアップZIPファイルを選択...", type=["zip"])
-        if uploaded_backup is not None:
-            backup_path = os.path.join(BACKUP_DIR, uploaded_backup.name)
-            with open(backup_path, 'wb') as f:
-                f.write(uploaded_backup.getbuffer())
-            try:
-                restore_backup(backup_path)
-                st.success("バックアップが正常に復元されました。")
-            except Exception as e:
-                st.error(f"バックアップの復元エラー: {e}")
+            # Backups append to the archive in place; it is only offered in between
+            last_backup = jobs.latest_job('backup')
+            appending = last_backup is not None and last_backup.status in jobs.ACTIVE_STATUSES
+            if backup_job is not None:
+                if backup_job.status == 'succeeded':
+                    backup_path = jobs.result_of(backup_job)['path']
+                    if os.path.exists(backup_path) and not appending:
+                        st.success("バックアップが作成されました。")
+                        with open(backup_path, 'rb') as f:
+                            st.download_button(label="バックアップをダウンロード", data=f, file_name='fashion_backup.zip')
+                elif backup_job.status == 'failed':
+                    st.error(f"バックアップの作成エラー: {backup_job.error}")
+
+            st.header('バックアップの復元')
+            uploaded_backup = st.file_uploader("バックアップZIPファイルを選択...", type=["zip"])
+            restore_job = jobs.latest_job('restore', user.id)
+            restore_running = restore_job is not None and restore_job.status in jobs.ACTIVE_STATUSES
+            if uploaded_backup is not None and st.button('復元を開始', disabled=restore_running):
+                # Kept apart from BACKUP_FILE so a restore never clobbers the incremental archive
+                backup_path = os.path.join(BACKUP_DIR, f'restore_upload_{uuid.uuid4().hex}.zip')
+                with open(backup_path, 'wb') as f:
+                    f.write(uploaded_backup.getbuffer())
+                jobs.submit('restore', {'path': backup_path, 'remove': True}, user.id)
+                st.rerun()
 
-    # Load images from directory into the database (if not already present)
-    load_images_from_directory()
+            if restore_job is not None:
+                if restore_job.status == 'succeeded':
+                    result = jobs.result_of(restore_job)
+                    st.success(f"バックアップが正常に復元されました。(復元: {result['restored']} 件, 変更なし: {result['skipped']} 件)")
+                elif restore_job.status in ('failed', 'interrupted'):
+                    st.error(f"バックアップの復元エラー: {restore_job.error or JOB_STATUS_LABELS[restore_job.status]}")
+            show_active_jobs(user.id, ['backup', 'restore'])
+
+        elif page == 'ジョブ':
+            st.header('ジョブ')
+            job_count = jobs.count_jobs(user.id)
+            if job_count == 0:
+                st.write("ジョブはまだありません。")
+            else:
+                job_page = select_page(job_count, 'job_page')
+                for job in jobs.load_jobs_page(user.id, job_page, PAGE_SIZE):
+                    cols = st.columns([3, 2, 1])
+                    created = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job.created_at))
+                    cols[0].write(f"#{job.id} {JOB_LABELS.get(job.kind, job.kind)} ({created})")
+                    progress = f" {job.done}/{job.total}" if job.total else ""
+                    cols[1].write(f"{JOB_STATUS_LABELS[job.status]}{progress}")
+                    if job.error:
+                        cols[0].caption(job.error)
+                    if jobs.can_cancel(job):
+                        if cols[2].button('キャンセル', key=f'cancel_job_{job.id}'):
+                            jobs.cancel(job.id)
+                            st.rerun()
+                    elif job.status in ('failed', 'interrupted'):
+                        if cols[2].button('再実行', key=f'retry_job_{job.id}'):
+                            jobs.retry(job.id)
+                            st.rerun()
+                show_active_jobs(user.id)
+
+finally:
+    session.close()
+    if metrics is not None:
+        instrumentation.finish_rerun(metrics)
+        if show_debug:
+            show_debug_panel(metrics)
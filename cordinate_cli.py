@@ -0,0 +1,350 @@
+"""
+Command-line maintenance of the wardrobe database and upload store, for
+batch jobs that should not go through the Streamlit UI.
+
+    python cordinate_cli.py import alice ~/wardrobe --map tops=top --map pants=bottom
+    python cordinate_cli.py orphans --fix
+    python cordinate_cli.py check --fix
+    python cordinate_cli.py export alice alice.zip
+    python cordinate_cli.py backup
+    python cordinate_cli.py restore fashion_backup.zip
+
+Bulk operations work in chunks with one transaction each, so they scale to
+tens of thousands of files and can run while the app is serving. Imports,
+restores and fixes change the suggestion generation token, so a running
+app reloads its in-memory suggestion indexes within a few seconds.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import zipfile
+
+from sqlalchemy import or_
+from sqlalchemy.orm import aliased
+
+import jobs
+import storage
+from backup import STORED_EXTENSIONS
+from database import open_session
+from models import Image, User, Dislike, Favorite
+from suggestions import SUGGESTION_CATEGORIES, invalidate_suggestion_indexes
+
+# Category of images that have not been sorted yet, as in the upload directory sync
+UNSORTED_CATEGORY = '未分類'
+CATEGORIES = SUGGESTION_CATEGORIES + (UNSORTED_CATEGORY,)
+
+# File types accepted by the upload page
+IMPORT_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.heic'}
+# Rows deleted or streamed per transaction / query batch
+ROW_CHUNK = 1000
+
+def report(message):
+    print(message, file=sys.stderr)
+
+def progress_printer(label):
+    def progress(done, total):
+        report(f'{label}: {done}/{total}')
+    return progress
+
+def run_job(kind, params=None, user_id=None):
+    """
+    Queue a job and run it in this process, so that it waits for
+    conflicting jobs of the app (a backup in progress, a restore) like
+    the app's own jobs do. Returns the job's result.
+    """
+    job_id = jobs.submit(kind, params, user_id)
+    job = jobs.wait(job_id, claim=True, progress=progress_printer(kind))
+    if job.status != 'succeeded':
+        raise SystemExit(f'{kind} {job.status}' + (f': {job.error}' if job.error else ''))
+    return jobs.result_of(job)
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def get_user(session, username):
+    user = session.query(User).filter_by(username=username).first()
+    if user is None:
+        raise SystemExit(f'unknown user: {username}')
+    return user
+
+def import_category(folder, mapping, default):
+    """
+    Category of a top-level folder of an import tree, or None to skip it.
+    """
+    category = mapping.get(folder, folder).lower()
+    return category if category in CATEGORIES else default
+
+def scan_import_tree(root, mapping, default):
+    """
+    Yield (category, path) for the image files below root, by the top-level
+    folder they are in. Files directly in root get the default category.
+    """
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = sorted(name for name in dirs if not name.startswith('.'))
+        relative = os.path.relpath(directory, root)
+        folder = None if relative == '.' else relative.split(os.sep)[0]
+        category = default if folder is None else import_category(folder, mapping, default)
+        if category is None:
+            if os.sep not in relative and relative != '.':
+                report(f'skipping folder {folder}: no category')
+            dirs[:] = []
+            continue
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in IMPORT_EXTENSIONS:
+                yield category, os.path.join(directory, name)
+
+def command_import(args):
+    mapping = {}
+    for entry in args.map:
+        folder, separator, category = entry.partition('=')
+        if not separator or category.lower() not in CATEGORIES:
+            raise SystemExit(f'invalid --map {entry!r}: expected FOLDER=CATEGORY with one of {", ".join(CATEGORIES)}')
+        mapping[folder] = category
+    default = None if args.skip_unsorted else UNSORTED_CATEGORY
+
+    session = open_session()
+    try:
+        user = get_user(session, args.username)
+    finally:
+        session.close()
+    files = [
+        [category, os.path.abspath(path)] for category, path in scan_import_tree(args.directory, mapping, default)
+    ]
+    directory = jobs.stage_file_list(files)
+    result = run_job('import_files', {'directory': directory, 'username': user.username, 'chunk': args.chunk}, user.id)
+    if args.verbose:
+        for file_name, error in result['errors']:
+            report(f'{file_name}: {error}')
+    print(json.dumps({'files': len(files), 'added': result['added'], 'skipped': len(result['errors'])}))
+
+def find_orphans(session):
+    """
+    Compare the upload store with the images table. Returns the unreferenced
+    blobs, the files of user directories that have no row, the files of
+    directories without a user, and the (id, path) of rows whose file is
+    missing, plus the thumbnail directories of deleted images.
+    """
+    known_paths = set()
+    missing = []
+    for image_id, path in session.query(Image.id, Image.path).yield_per(ROW_CHUNK):
+        known_paths.add(path)
+        if not os.path.exists(path):
+            missing.append((image_id, path))
+    usernames = {username for (username,) in session.query(User.username)}
+
+    blobs = []
+    unregistered = {}
+    unowned = []
+    for directory, dirs, files in os.walk(storage.UPLOAD_DIR):
+        relative = os.path.relpath(directory, storage.UPLOAD_DIR)
+        owner = relative.split(os.sep)[0]
+        for name in files:
+            path = os.path.join(directory, name)
+            if path in known_paths:
+                continue
+            if directory == storage.UPLOAD_DIR:
+                unowned.append(path)
+            elif directory.startswith(storage.BLOB_DIR):
+                blobs.append(path)
+            elif owner in usernames and directory == os.path.join(storage.UPLOAD_DIR, owner):
+                unregistered.setdefault(owner, []).append(path)
+            else:
+                unowned.append(path)
+
+    image_ids = {str(image_id) for (image_id,) in session.query(Image.id).yield_per(ROW_CHUNK)}
+    thumbnails = []
+    if os.path.isdir(storage.THUMBNAIL_DIR):
+        with os.scandir(storage.THUMBNAIL_DIR) as it:
+            for entry in it:
+                if entry.is_dir() and entry.name.isdigit() and entry.name not in image_ids:
+                    thumbnails.append(entry.name)
+    return blobs, unregistered, unowned, missing, thumbnails
+
+def command_orphans(args):
+    session = open_session()
+    try:
+        blobs, unregistered, unowned, missing, thumbnails = find_orphans(session)
+        summary = {
+            'unreferenced_blobs': len(blobs),
+            'unregistered_files': sum(len(paths) for paths in unregistered.values()),
+            'unowned_files': len(unowned),
+            'missing_files': len(missing),
+            'stale_thumbnails': len(thumbnails),
+        }
+        if args.verbose:
+            for path in blobs:
+                report(f'unreferenced blob: {path}')
+            for paths in unregistered.values():
+                for path in paths:
+                    report(f'unregistered file: {path}')
+            for path in unowned:
+                report(f'unowned file: {path}')
+            for image_id, path in missing:
+                report(f'missing file of image {image_id}: {path}')
+        if not args.fix:
+            print(json.dumps(summary))
+            return
+
+        # Files dropped into a user directory are registered, as the app's
+        # directory sync would do
+        for username, paths in unregistered.items():
+            storage.sync_upload_directory(session, get_user(session, username))
+        cutoff = time.time() - storage.BLOB_GRACE_SECONDS
+        removed_blobs = 0
+        for path in blobs:
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+                    removed_blobs += 1
+            except FileNotFoundError:
+                pass
+        for chunk in chunks([image_id for image_id, path in missing], ROW_CHUNK):
+            storage.delete_feedback(session, chunk)
+            session.query(Image).filter(Image.id.in_(chunk)).delete(synchronize_session=False)
+            session.commit()
+            for image_id in chunk:
+                storage.delete_thumbnails(image_id)
+        for image_id in thumbnails:
+            storage.delete_thumbnails(image_id)
+        if unregistered or missing:
+            invalidate_suggestion_indexes()
+        summary.update(removed_blobs=removed_blobs, removed_rows=len(missing))
+        print(json.dumps(summary))
+    finally:
+        session.close()
+
+def find_broken_feedback(session, model):
+    """
+    Ids of the model's feedback rows that refer to a deleted image, to an
+    image of another user, or lack the top or bottom.
+    """
+    conditions = [model.top_id.is_(None), model.bottom_id.is_(None)]
+    query = session.query(model.id)
+    for column in (model.top_id, model.bottom_id, model.shoes_id, model.accessory_id):
+        image = aliased(Image)
+        query = query.outerjoin(image, image.id == column)
+        conditions.append((column.isnot(None)) & (image.id.is_(None) | (image.user_id != model.user_id)))
+    return [feedback_id for (feedback_id,) in query.filter(or_(*conditions)).order_by(model.id)]
+
+def command_check(args):
+    session = open_session()
+    try:
+        summary = {}
+        fixed = False
+        for model in (Favorite, Dislike):
+            broken = find_broken_feedback(session, model)
+            summary[model.__tablename__] = len(broken)
+            if args.verbose and broken:
+                report(f'broken {model.__tablename__}: {", ".join(map(str, broken))}')
+            if args.fix:
+                for chunk in chunks(broken, ROW_CHUNK):
+                    session.query(model).filter(model.id.in_(chunk)).delete(synchronize_session=False)
+                    session.commit()
+                    fixed = True
+        if fixed:
+            invalidate_suggestion_indexes()
+        summary['fixed'] = args.fix
+        print(json.dumps(summary))
+    finally:
+        session.close()
+
+def command_export(args):
+    """
+    Write the user's images as <category>/<id>_<name> together with
+    images.jsonl, favorites.jsonl and dislikes.jsonl to a zip archive.
+    Rows are streamed in batches and files are copied from disk one at a
+    time, so the archive can be written to stdout with -.
+    """
+    session = open_session()
+    try:
+        user = get_user(session, args.username)
+        output = sys.stdout.buffer if args.output == '-' else args.output
+        exported = 0
+        with zipfile.ZipFile(output, 'w') as zipf:
+            with zipf.open('images.jsonl', 'w') as records:
+                query = session.query(Image.id, Image.category, Image.path, Image.content_hash).filter_by(
+                    user_id=user.id
+                ).order_by(Image.id)
+                for image_id, category, path, content_hash in query.yield_per(ROW_CHUNK):
+                    arcname = f'{category or UNSORTED_CATEGORY}/{image_id}_{os.path.basename(path)}'
+                    record = {'id': image_id, 'category': category, 'file': arcname, 'content_hash': content_hash}
+                    if not os.path.exists(path):
+                        record['file'] = None
+                    records.write((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+            # Written in a second pass: a zip member must be closed before the next one starts
+            for image_id, category, path, content_hash in query.yield_per(ROW_CHUNK):
+                if not os.path.exists(path):
+                    continue
+                extension = os.path.splitext(path)[1].lower()
+                compress_type = zipfile.ZIP_STORED if extension in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+                zipf.write(path, f'{category or UNSORTED_CATEGORY}/{image_id}_{os.path.basename(path)}', compress_type)
+                exported += 1
+                if exported % ROW_CHUNK == 0:
+                    report(f'export: {exported} files')
+            for model in (Favorite, Dislike):
+                with zipf.open(f'{model.__tablename__}.jsonl', 'w') as records:
+                    rows = session.query(
+                        model.top_id, model.bottom_id, model.shoes_id, model.accessory_id
+                    ).filter_by(user_id=user.id).order_by(model.id)
+                    for top_id, bottom_id, shoes_id, accessory_id in rows.yield_per(ROW_CHUNK):
+                        record = {'top': top_id, 'bottom': bottom_id, 'shoes': shoes_id, 'accessory': accessory_id}
+                        records.write((json.dumps(record) + '\n').encode('utf-8'))
+    finally:
+        session.close()
+    report(f'export: {exported} files')
+
+def command_backup(args):
+    print(run_job('backup')['path'])
+
+def command_restore(args):
+    print(json.dumps(run_job('restore', {'path': os.path.abspath(args.backup_file)})))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-v', '--verbose', action='store_true', help='list every affected file or row')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_import = commands.add_parser('import', help='import a directory tree of images for a user')
+    parser_import.add_argument('username')
+    parser_import.add_argument('directory', help='top-level folders name the category of the images in them')
+    parser_import.add_argument('--map', action='append', default=[], metavar='FOLDER=CATEGORY',
+                               help='category of a folder whose name is not a category')
+    parser_import.add_argument('--skip-unsorted', action='store_true',
+                               help=f'skip files outside category folders instead of importing them as {UNSORTED_CATEGORY}')
+    parser_import.add_argument('--chunk', type=int, default=jobs.IMPORT_CHUNK, help='images per transaction')
+    parser_import.set_defaults(function=command_import)
+
+    parser_orphans = commands.add_parser('orphans', help='compare the upload store with the images table')
+    parser_orphans.add_argument('--fix', action='store_true',
+                                help='register unregistered files, remove unreferenced blobs and rows of missing files')
+    parser_orphans.set_defaults(function=command_orphans)
+
+    parser_check = commands.add_parser('check', help='find favorites and dislikes that refer to deleted images')
+    parser_check.add_argument('--fix', action='store_true', help='delete the broken rows')
+    parser_check.set_defaults(function=command_check)
+
+    parser_export = commands.add_parser('export', help="write a user's images and feedback to a zip archive")
+    parser_export.add_argument('username')
+    parser_export.add_argument('output', help='archive path, or - for stdout')
+    parser_export.set_defaults(function=command_export)
+
+    parser_backup = commands.add_parser('backup', help='update the backup archive')
+    parser_backup.set_defaults(function=command_backup)
+
+    parser_restore = commands.add_parser('restore', help='restore a backup archive')
+    parser_restore.add_argument('backup_file')
+    parser_restore.set_defaults(function=command_restore)
+
+    args = parser.parse_args(argv)
+    # Same directories as the app, relative to the working directory
+    storage.ensure_directories()
+    try:
+        args.function(args)
+    finally:
+        storage.shutdown_upload_executor()
+
+if __name__ == '__main__':
+    main()
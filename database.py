@@ -0,0 +1,133 @@
+"""
+Engine, sessions and schema migrations.
+
+Nothing is created on import: get_engine() builds the engine, the schema
+and runs pending migrations the first time it is called in a process.
+"""
+import threading
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateIndex
+
+import instrumentation
+from auth import BCRYPT_PREFIXES, hash_password
+from models import Base, Image, Dislike, Favorite
+
+DB_PATH = 'fashion.db'
+
+def create_indexes(connection, names):
+    for model in (Image, Dislike, Favorite):
+        for index in model.__table__.indexes:
+            if index.name in names:
+                connection.execute(CreateIndex(index, if_not_exists=True))
+
+def migrate_add_indexes(connection):
+    """
+    Merge duplicate images and feedback rows, then create the indexes.
+    """
+    duplicates = connection.exec_driver_sql(
+        "SELECT user_id, path, MIN(id) FROM images GROUP BY user_id, path HAVING COUNT(*) > 1"
+    ).fetchall()
+    for user_id, path, keep_id in duplicates:
+        duplicate_ids = [row[0] for row in connection.exec_driver_sql(
+            "SELECT id FROM images WHERE user_id IS ? AND path IS ? AND id != ?", (user_id, path, keep_id)
+        )]
+        for duplicate_id in duplicate_ids:
+            for table in ('dislikes', 'favorites'):
+                for column in ('top_id', 'bottom_id', 'shoes_id', 'accessory_id'):
+                    connection.exec_driver_sql(
+                        f"UPDATE {table} SET {column} = ? WHERE {column} = ?", (keep_id, duplicate_id)
+                    )
+            connection.exec_driver_sql("DELETE FROM images WHERE id = ?", (duplicate_id,))
+    for table in ('dislikes', 'favorites'):
+        connection.exec_driver_sql(
+            f"DELETE FROM {table} WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY user_id, "
+            "top_id, bottom_id, COALESCE(shoes_id, 0), COALESCE(accessory_id, 0))"
+        )
+    create_indexes(connection, [
+        'ix_images_user_category', 'ux_images_user_path',
+        'ux_dislikes_combination', 'ux_favorites_combination',
+    ])
+
+def migrate_hash_legacy_passwords(connection):
+    """
+    Replace plain-text passwords left by early versions with bcrypt hashes.
+    """
+    users = connection.exec_driver_sql("SELECT id, password FROM users").fetchall()
+    for user_id, password in users:
+        if not password.startswith(BCRYPT_PREFIXES):
+            connection.exec_driver_sql(
+                "UPDATE users SET password = ? WHERE id = ?", (hash_password(password), user_id)
+            )
+
+def migrate_add_image_hashes(connection):
+    """
+    Add the content and source hash columns used by the blob store.
+    """
+    columns = {row[1] for row in connection.exec_driver_sql("PRAGMA table_info(images)")}
+    for column in ('content_hash', 'source_hash'):
+        if column not in columns:
+            connection.exec_driver_sql(f"ALTER TABLE images ADD COLUMN {column} VARCHAR")
+    create_indexes(connection, ['ix_images_path', 'ix_images_user_source_hash'])
+
+# Schema migrations, applied in order. The number of applied migrations is
+# stored in the SQLite user_version pragma; new migrations are appended.
+MIGRATIONS = [
+    migrate_add_indexes,
+    migrate_hash_legacy_passwords,
+    migrate_add_image_hashes,
+]
+
+def run_migrations(engine):
+    with engine.connect() as connection:
+        version = connection.exec_driver_sql("PRAGMA user_version").scalar()
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        with engine.begin() as connection:
+            migration(connection)
+            connection.exec_driver_sql(f"PRAGMA user_version = {number}")
+
+def init_schema(engine):
+    Base.metadata.create_all(engine)
+    run_migrations(engine)
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # WAL lets readers run while a write is in progress; writers wait for
+    # the lock instead of failing with "database is locked".
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.close()
+
+# Bound to the engine by get_engine()
+Session = sessionmaker()
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """
+    Return the process-wide engine, creating it together with the schema
+    and pending migrations on first use.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            engine = create_engine(
+                f'sqlite:///{DB_PATH}',
+                connect_args={'check_same_thread': False},
+                pool_size=10,
+                max_overflow=20,
+                pool_timeout=30,
+            )
+            event.listen(engine, 'connect', _set_sqlite_pragmas)
+            instrumentation.install(engine)
+            init_schema(engine)
+            Session.configure(bind=engine)
+            _engine = engine
+    return _engine
+
+def open_session():
+    get_engine()
+    return Session()
@@ -0,0 +1,111 @@
+"""
+Image decoding and encoding used by the upload and thumbnail pipelines.
+
+These functions run in worker processes, so they live outside
+cordinate_app.py: Streamlit executes the app as __main__, which process
+pool workers cannot import.
+"""
+import hashlib
+import io
+import os
+import threading
+
+from PIL import Image as PILImage, ImageOps
+
+# Uploads are stored as PNG when they are PNG and as JPEG otherwise;
+# HEIC in particular is converted since browsers cannot display it.
+PNG_EXTENSIONS = {'.png'}
+
+_heif_registered = False
+
+def register_heif():
+    global _heif_registered
+    if not _heif_registered:
+        import pillow_heif
+        pillow_heif.register_heif_opener()
+        _heif_registered = True
+
+def blob_path(blob_dir, content_hash, extension):
+    return os.path.join(blob_dir, content_hash[:2], content_hash + extension)
+
+def _tmp_path(path):
+    # Unique per process and thread so concurrent writers never share it
+    return f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+def _atomic_save(img, dest_path, **params):
+    tmp_path = _tmp_path(dest_path)
+    img.save(tmp_path, **params)
+    os.replace(tmp_path, dest_path)
+
+def normalize_image(data, file_name, blob_dir, max_dimension):
+    """
+    Decode uploaded HEIC/JPEG/PNG bytes, apply the EXIF orientation and
+    downscale to fit max_dimension. The encoded result is stored in
+    blob_dir under the sha256 of its bytes; an existing blob is touched
+    instead, which keeps delete_images() from removing it while the new
+    row is not committed yet. Returns (content hash, blob path).
+    """
+    register_heif()
+    buffer = io.BytesIO()
+    with PILImage.open(io.BytesIO(data)) as img:
+        img.draft('RGB', (max_dimension, max_dimension))
+        normalized = ImageOps.exif_transpose(img)
+        normalized.thumbnail((max_dimension, max_dimension))
+        if os.path.splitext(file_name)[1].lower() in PNG_EXTENSIONS:
+            normalized.save(buffer, format='PNG')
+            extension = '.png'
+        else:
+            if normalized.mode != 'RGB':
+                normalized = normalized.convert('RGB')
+            normalized.save(buffer, format='JPEG', quality=90)
+            extension = '.jpg'
+    encoded = buffer.getvalue()
+    content_hash = hashlib.sha256(encoded).hexdigest()
+    path = blob_path(blob_dir, content_hash, extension)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = _tmp_path(path)
+        with open(tmp_path, 'wb') as f:
+            f.write(encoded)
+        os.replace(tmp_path, path)
+    return content_hash, path
+
+def write_thumbnails(source_path, targets):
+    """
+    Write JPEG thumbnails of source_path for every (thumb_path, size) in
+    targets, decoding the source only once.
+    """
+    register_heif()
+    largest = max(size for thumb_path, size in targets)
+    with PILImage.open(source_path) as img:
+        # Let the JPEG decoder downscale while decoding
+        img.draft('RGB', (largest, largest))
+        thumb = ImageOps.exif_transpose(img)
+        if thumb.mode != 'RGB':
+            thumb = thumb.convert('RGB')
+        for thumb_path, size in sorted(targets, key=lambda target: -target[1]):
+            thumb.thumbnail((size, size))
+            _atomic_save(thumb, thumb_path, format='JPEG', quality=85)
+
+def render_collage(source_paths, tile_size):
+    """
+    Compose the images side by side into one strip of square tiles and
+    return it as JPEG bytes.
+    """
+    register_heif()
+    collage = PILImage.new('RGB', (tile_size * len(source_paths), tile_size), 'white')
+    for position, source_path in enumerate(source_paths):
+        with PILImage.open(source_path) as img:
+            img.draft('RGB', (tile_size, tile_size))
+            tile = ImageOps.exif_transpose(img)
+            if tile.mode != 'RGB':
+                tile = tile.convert('RGB')
+            tile.thumbnail((tile_size, tile_size))
+            collage.paste(tile, (
+                position * tile_size + (tile_size - tile.width) // 2, (tile_size - tile.height) // 2
+            ))
+    buffer = io.BytesIO()
+    collage.save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
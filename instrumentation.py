@@ -0,0 +1,216 @@
+"""
+Opt-in per-rerun instrumentation: SQL statements and named stages.
+
+Nothing is recorded unless a RerunMetrics is active in the current context
+(see start_rerun), so the hooks cost one context variable lookup otherwise.
+Collection is enabled with CORDINATE_DEBUG=1 (or ?debug=1 in the app URL),
+and each finished rerun can be exported to a log (CORDINATE_METRICS_LOG=1)
+and to a Prometheus text file (CORDINATE_METRICS_FILE=<path>).
+"""
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+DEBUG = os.environ.get('CORDINATE_DEBUG', '') == '1'
+METRICS_LOG = os.environ.get('CORDINATE_METRICS_LOG', '') == '1'
+METRICS_FILE = os.environ.get('CORDINATE_METRICS_FILE') or None
+
+# A statement executed this many times in one rerun is reported as a
+# likely N+1 query
+N_PLUS_ONE_THRESHOLD = 5
+
+logger = logging.getLogger('cordinate.metrics')
+
+_current = contextvars.ContextVar('rerun_metrics', default=None)
+
+class RerunMetrics:
+    """
+    Queries and stage timings recorded during one script run.
+    """
+
+    def __init__(self, name=''):
+        self.name = name
+        self.started = time.perf_counter()
+        self.duration = None
+        # (statement, seconds) in execution order
+        self.queries = []
+        # stage name -> [calls, seconds]
+        self.stages = {}
+        self.notes = {}
+        # Names of the stages currently running, outermost first
+        self._active = []
+        self._top_level = 0.0
+
+    def add_stage(self, name, seconds, top_level):
+        entry = self.stages.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+        if top_level:
+            self._top_level += seconds
+
+    def note(self, key, value):
+        self.notes[key] = value
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+
+    def query_seconds(self):
+        return sum(seconds for statement, seconds in self.queries)
+
+    def unattributed_seconds(self):
+        """
+        Time spent outside every stage: rendering and the remaining script.
+        """
+        return max(0.0, (self.duration or 0.0) - self._top_level)
+
+    def repeated_statements(self, threshold=N_PLUS_ONE_THRESHOLD):
+        counts = Counter(statement for statement, seconds in self.queries)
+        return [(statement, count) for statement, count in counts.most_common() if count >= threshold]
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'seconds': self.duration,
+            'queries': len(self.queries),
+            'query_seconds': self.query_seconds(),
+            'stages': {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in self.stages.items()},
+            'unattributed_seconds': self.unattributed_seconds(),
+            'repeated_statements': [
+                {'statement': statement, 'count': count} for statement, count in self.repeated_statements()
+            ],
+            'notes': self.notes,
+        }
+
+def collection_enabled():
+    return DEBUG or METRICS_LOG or METRICS_FILE is not None
+
+def start_rerun(name=''):
+    metrics = RerunMetrics(name)
+    _current.set(metrics)
+    return metrics
+
+def finish_rerun(metrics):
+    """
+    Stop recording and export the rerun where configured.
+    """
+    metrics.finish()
+    if _current.get() is metrics:
+        _current.set(None)
+    if METRICS_LOG:
+        logger.info(json.dumps(metrics.to_dict(), ensure_ascii=False))
+    if METRICS_FILE is not None:
+        _totals.add(metrics)
+        _totals.write(METRICS_FILE)
+
+def note(key, value):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.note(key, value)
+
+@contextmanager
+def stage(name):
+    metrics = _current.get()
+    # A stage re-entered through a nested call is only counted once
+    if metrics is None or name in metrics._active:
+        yield
+        return
+    metrics._active.append(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics._active.pop()
+        metrics.add_stage(name, time.perf_counter() - start, not metrics._active)
+
+def timed(name):
+    """
+    Decorator recording every call of the function as the named stage.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return function(*args, **kwargs)
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics = _current.get()
+    starts = conn.info.get('query_start')
+    if metrics is not None and starts:
+        metrics.queries.append((statement, time.perf_counter() - starts.pop()))
+
+def install(engine):
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+class MetricsTotals:
+    """
+    Process-wide counters written out in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reruns = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.repeated = 0
+        self.stages = {}
+
+    def add(self, metrics):
+        with self.lock:
+            self.reruns += 1
+            self.seconds += metrics.duration
+            self.queries += len(metrics.queries)
+            self.query_seconds += metrics.query_seconds()
+            self.repeated += len(metrics.repeated_statements())
+            for name, (calls, seconds) in metrics.stages.items():
+                entry = self.stages.setdefault(name, [0, 0.0])
+                entry[0] += calls
+                entry[1] += seconds
+
+    def render(self):
+        with self.lock:
+            lines = [
+                '# TYPE cordinate_reruns_total counter',
+                f'cordinate_reruns_total {self.reruns}',
+                '# TYPE cordinate_rerun_seconds_total counter',
+                f'cordinate_rerun_seconds_total {self.seconds:.6f}',
+                '# TYPE cordinate_queries_total counter',
+                f'cordinate_queries_total {self.queries}',
+                '# TYPE cordinate_query_seconds_total counter',
+                f'cordinate_query_seconds_total {self.query_seconds:.6f}',
+                '# TYPE cordinate_repeated_statements_total counter',
+                f'cordinate_repeated_statements_total {self.repeated}',
+                '# TYPE cordinate_stage_calls_total counter',
+            ]
+            lines += [f'cordinate_stage_calls_total{{stage="{name}"}} {calls}'
+                      for name, (calls, seconds) in sorted(self.stages.items())]
+            lines.append('# TYPE cordinate_stage_seconds_total counter')
+            lines += [f'cordinate_stage_seconds_total{{stage="{name}"}} {seconds:.6f}'
+                      for name, (calls, seconds) in sorted(self.stages.items())]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # Scrapers never see a partially written file
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+_totals = MetricsTotals()
@@ -0,0 +1,536 @@
+"""
+Persistent background jobs for the heavy operations: backup, restore,
+bulk import of uploaded files, thumbnail rebuilds and directory syncs.
+
+Jobs are rows of the jobs table, so they outlive reruns and show up for
+every session. A small pool of worker threads (JOB_WORKERS) claims queued
+jobs in order, which bounds how much CPU and I/O they take from the
+interactive reruns. Handlers report progress through their JobContext,
+which is also where cancellation requests are noticed.
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from auth import SessionUser
+from database import open_session
+from models import Image, Job
+
+JOB_WORKERS = int(os.environ.get('CORDINATE_JOB_WORKERS', '2'))
+# Seconds between progress writes, and between looks for jobs queued by
+# other processes
+PROGRESS_INTERVAL = 0.5
+POLL_SECONDS = 2.0
+# Finished jobs are forgotten after this many seconds
+JOB_RETENTION_SECONDS = 7 * 24 * 3600
+
+# Uploaded files wait here until their import job has stored them
+STAGING_DIR = 'staging'
+IMPORT_CHUNK = 32
+THUMBNAIL_CHUNK = 64
+
+ACTIVE_STATUSES = ('queued', 'running')
+FINISHED_STATUSES = ('succeeded', 'failed', 'cancelled', 'interrupted')
+
+logger = logging.getLogger('cordinate.jobs')
+
+class JobCancelled(Exception):
+    pass
+
+class JobContext:
+    """
+    Handed to a job handler: its arguments and progress reporting. For
+    cancellable kinds, progress() raises JobCancelled once cancellation
+    was requested.
+    """
+
+    def __init__(self, job_id, user_id, params, cancellable):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.params = params
+        self.cancellable = cancellable
+        self._last_write = 0.0
+
+    def progress(self, done, total):
+        now = time.monotonic()
+        if done < total and now - self._last_write < PROGRESS_INTERVAL:
+            return
+        self._last_write = now
+        session = open_session()
+        try:
+            session.query(Job).filter_by(id=self.job_id).update({Job.done: done, Job.total: total})
+            session.commit()
+            cancel_requested = session.query(Job.cancel_requested).filter_by(id=self.job_id).scalar()
+        finally:
+            session.close()
+        if cancel_requested and self.cancellable:
+            raise JobCancelled()
+
+# kind -> (handler, scope, cancellable). At most one job runs at a time
+# per kind and user for scope 'user', per kind for 'global', and an
+# 'exclusive' job runs alone. Jobs that are not cancellable can only be
+# cancelled while they are queued.
+_handlers = {}
+
+def handler(kind, scope='user', cancellable=False):
+    def decorator(function):
+        _handlers[kind] = (function, scope, cancellable)
+        return function
+    return decorator
+
+def can_cancel(job):
+    return job.status == 'queued' or (job.status == 'running' and _handlers.get(job.kind, (None, None, False))[2])
+
+def result_of(job):
+    return json.loads(job.result) if job.result else None
+
+def submit(kind, params=None, user_id=None, unique=False):
+    """
+    Queue a job and return its id. With unique=True an already queued or
+    running job of the same kind and user is returned instead.
+    """
+    if kind not in _handlers:
+        raise ValueError(f"unknown job kind: {kind}")
+    session = open_session()
+    try:
+        if unique:
+            existing = session.query(Job.id).filter(
+                Job.kind == kind, Job.user_id == user_id, Job.status.in_(ACTIVE_STATUSES)
+            ).first()
+            if existing is not None:
+                return existing[0]
+        job = Job(kind=kind, user_id=user_id, params=json.dumps(params or {}), created_at=time.time())
+        session.add(job)
+        session.commit()
+        job_id = job.id
+    finally:
+        session.close()
+    _notify()
+    return job_id
+
+def retry(job_id):
+    """
+    Queue a new job with the arguments of a failed or interrupted one.
+    """
+    job = get_job(job_id)
+    return submit(job.kind, json.loads(job.params), job.user_id)
+
+def cancel(job_id):
+    """
+    Cancel a queued job, or ask a running one to stop at its next
+    progress report.
+    """
+    session = open_session()
+    try:
+        session.query(Job).filter(Job.id == job_id, Job.status == 'queued').update(
+            {Job.status: 'cancelled', Job.finished_at: time.time()}, synchronize_session=False
+        )
+        session.query(Job).filter(Job.id == job_id, Job.status == 'running').update(
+            {Job.cancel_requested: True}, synchronize_session=False
+        )
+        session.commit()
+    finally:
+        session.close()
+
+def get_job(job_id):
+    session = open_session()
+    try:
+        return session.get(Job, job_id)
+    finally:
+        session.close()
+
+def active_jobs(user_id, kinds=None):
+    session = open_session()
+    try:
+        query = session.query(Job).filter(Job.user_id == user_id, Job.status.in_(ACTIVE_STATUSES))
+        if kinds is not None:
+            query = query.filter(Job.kind.in_(kinds))
+        return query.order_by(Job.id).all()
+    finally:
+        session.close()
+
+def latest_job(kind, user_id=None):
+    session = open_session()
+    try:
+        query = session.query(Job).filter(Job.kind == kind)
+        if user_id is not None:
+            query = query.filter(Job.user_id == user_id)
+        return query.order_by(Job.id.desc()).first()
+    finally:
+        session.close()
+
+def count_jobs(user_id):
+    session = open_session()
+    try:
+        return session.query(Job).filter_by(user_id=user_id).count()
+    finally:
+        session.close()
+
+def load_jobs_page(user_id, page, page_size):
+    session = open_session()
+    try:
+        return session.query(Job).filter_by(user_id=user_id).order_by(Job.id.desc()).limit(page_size).offset(
+            (page - 1) * page_size
+        ).all()
+    finally:
+        session.close()
+
+def wait(job_id, timeout=None, claim=False, progress=None):
+    """
+    Block until the job has finished and return it. With claim=True the
+    job is run by this process once the concurrency scopes allow it,
+    unless a worker (of any process) claimed it first; scripts use this
+    instead of starting workers that would also take other jobs.
+    progress(done, total) is called as the job reports progress.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    thread = None
+    reported = None
+    try:
+        while True:
+            job = get_job(job_id)
+            if job is None:
+                # Forgotten by recover_jobs() after JOB_RETENTION_SECONDS
+                raise LookupError(f"job {job_id} no longer exists")
+            if job.status in FINISHED_STATUSES:
+                return job
+            if progress is not None and job.total and (job.done, job.total) != reported:
+                reported = (job.done, job.total)
+                progress(job.done, job.total)
+            if claim and thread is None and job.status == 'queued':
+                claimed = _claim_next(only=job_id)
+                if claimed is not None:
+                    thread = threading.Thread(target=_run, args=claimed, name=f'job-{job_id}')
+                    thread.start()
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"job {job_id} is still {job.status}")
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        # A job run here would die with the process; stop it cleanly
+        if thread is not None:
+            cancel(job_id)
+        raise
+    finally:
+        if thread is not None:
+            # The job is marked finished before its thread ends
+            thread.join()
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def recover_jobs():
+    """
+    Mark jobs whose process died while running them as interrupted, and
+    forget old finished jobs together with their staged files.
+    """
+    now = time.time()
+    session = open_session()
+    try:
+        for job in session.query(Job).filter_by(status='running'):
+            if job.owner is None or job.owner == os.getpid() or not _pid_alive(job.owner):
+                job.status = 'interrupted'
+                job.finished_at = now
+        expired = session.query(Job).filter(
+            Job.status.in_(FINISHED_STATUSES), Job.finished_at < now - JOB_RETENTION_SECONDS
+        ).all()
+        for job in expired:
+            if job.kind in ('import', 'import_files'):
+                shutil.rmtree(json.loads(job.params)['directory'], ignore_errors=True)
+            session.delete(job)
+        session.commit()
+    finally:
+        session.close()
+
+def _conflicts(job, running):
+    scope = _handlers[job.kind][1]
+    for kind, user_id in running:
+        if scope == 'exclusive' or kind in _handlers and _handlers[kind][1] == 'exclusive':
+            return True
+        if kind == job.kind and (scope == 'global' or user_id == job.user_id):
+            return True
+    return False
+
+def _claim_next(only=None):
+    """
+    Mark the oldest queued job that may run now as running and return
+    (id, kind, user id, params), or None. With only, that job is claimed
+    or nothing.
+    """
+    with _claim_lock:
+        session = open_session()
+        try:
+            running = []
+            for job_id, kind, user_id, owner in session.query(Job.id, Job.kind, Job.user_id, Job.owner).filter_by(
+                status='running'
+            ).all():
+                # The process running it died, e.g. a killed command-line run
+                if owner is not None and owner != os.getpid() and not _pid_alive(owner):
+                    session.query(Job).filter(Job.id == job_id, Job.status == 'running').update(
+                        {Job.status: 'interrupted', Job.finished_at: time.time()}, synchronize_session=False
+                    )
+                    session.commit()
+                    continue
+                running.append((kind, user_id))
+            queued = session.query(Job).filter_by(status='queued').order_by(Job.id)
+            queued = queued.limit(100) if only is None else queued.filter(Job.id <= only)
+            for job in queued:
+                if job.kind not in _handlers:
+                    continue
+                if only is not None and job.id != only:
+                    # Queued earlier; an exclusive job keeps it waiting
+                    if _handlers[job.kind][1] == 'exclusive':
+                        return None
+                    continue
+                if _conflicts(job, running):
+                    # Later jobs must not keep a queued exclusive job waiting
+                    if _handlers[job.kind][1] == 'exclusive':
+                        return None
+                    continue
+                # The status check keeps other processes from claiming it too
+                claimed = session.query(Job).filter(Job.id == job.id, Job.status == 'queued').update(
+                    {Job.status: 'running', Job.owner: os.getpid(), Job.started_at: time.time()},
+                    synchronize_session=False
+                )
+                session.commit()
+                if claimed:
+                    return job.id, job.kind, job.user_id, json.loads(job.params)
+                return None
+            return None
+        finally:
+            session.close()
+
+def _run(job_id, kind, user_id, params):
+    function, scope, cancellable = _handlers[kind]
+    context = JobContext(job_id, user_id, params, cancellable)
+    result = None
+    error = None
+    try:
+        result = function(context, params)
+        status = 'succeeded'
+    except JobCancelled:
+        status = 'cancelled'
+    except Exception as e:
+        logger.exception("job %s (%s) failed", job_id, kind)
+        status = 'failed'
+        error = str(e)
+    session = open_session()
+    try:
+        session.query(Job).filter_by(id=job_id).update({
+            Job.status: status, Job.result: json.dumps(result), Job.error: error,
+            Job.finished_at: time.time(),
+        }, synchronize_session=False)
+        session.commit()
+    finally:
+        session.close()
+
+def _work_loop():
+    while True:
+        try:
+            job = _claim_next()
+        except Exception:
+            logger.exception("claiming a job failed")
+            job = None
+        if job is None:
+            with _wakeup:
+                _wakeup.wait(POLL_SECONDS)
+            continue
+        _run(*job)
+        # A finished job may unblock queued ones
+        _notify()
+
+_claim_lock = threading.Lock()
+_wakeup = threading.Condition()
+_workers = []
+_workers_lock = threading.Lock()
+
+def _notify():
+    with _wakeup:
+        _wakeup.notify_all()
+
+def start_workers(count=JOB_WORKERS):
+    """
+    Recover jobs left behind by a previous process and start the worker
+    threads, once per process.
+    """
+    with _workers_lock:
+        if _workers:
+            return
+        recover_jobs()
+        for number in range(count):
+            thread = threading.Thread(target=_work_loop, name=f'job-worker-{number}', daemon=True)
+            thread.start()
+            _workers.append(thread)
+
+def stage_files(uploads):
+    """
+    Write (file name, bytes) uploads to a fresh staging directory for an
+    import job and return the directory.
+    """
+    directory = os.path.join(STAGING_DIR, uuid.uuid4().hex)
+    os.makedirs(directory)
+    for number, (file_name, data) in enumerate(uploads):
+        # The prefix keeps the order and tells apart files with equal names
+        with open(os.path.join(directory, f'{number:06d}_{os.path.basename(file_name)}'), 'wb') as f:
+            f.write(data)
+    return directory
+
+def stage_file_list(files):
+    """
+    Write the [category, path] entries of an in-place import to a fresh
+    staging directory and return the directory, so that the job row stays
+    small however many files there are.
+    """
+    directory = os.path.join(STAGING_DIR, uuid.uuid4().hex)
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'files.json'), 'w') as f:
+        json.dump(files, f)
+    return directory
+
+def submit_import(user, uploads, category):
+    directory = stage_files(uploads)
+    return submit('import', {'directory': directory, 'username': user.username, 'category': category}, user.id)
+
+def _import_files(context, user, files, chunk=IMPORT_CHUNK):
+    """
+    Store (category, file name, path) entries in chunks, one transaction
+    per chunk and category. Returns the number of added images and the
+    (file name, error message) list of the others.
+    """
+    from storage import evict_thumbnails, upload_images
+
+    files = sorted(files, key=lambda entry: entry[0])
+    added = 0
+    errors = []
+    context.progress(0, len(files))
+    session = open_session()
+    try:
+        for start in range(0, len(files), chunk):
+            uploads = {}
+            for category, file_name, path in files[start:start + chunk]:
+                try:
+                    with open(path, 'rb') as f:
+                        uploads.setdefault(category, []).append((file_name, f.read()))
+                except OSError as e:
+                    errors.append((file_name, str(e)))
+            for category, category_uploads in uploads.items():
+                new_images, chunk_errors = upload_images(session, user, category_uploads, category, evict=False)
+                added += len(new_images)
+                errors += chunk_errors
+            context.progress(min(start + chunk, len(files)), len(files))
+    finally:
+        session.close()
+    evict_thumbnails()
+    return added, errors
+
+@handler('import', cancellable=True)
+def run_import(context, params):
+    """
+    Store staged uploads.
+    """
+    directory = params['directory']
+    files = [
+        (params['category'], name.split('_', 1)[1], os.path.join(directory, name))
+        for name in sorted(os.listdir(directory))
+    ]
+    try:
+        added, errors = _import_files(context, SessionUser(context.user_id, params['username']), files)
+    except JobCancelled:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+    # Failed imports keep their files so that they can be retried
+    shutil.rmtree(directory, ignore_errors=True)
+    return {'added': added, 'errors': errors}
+
+@handler('import_files', cancellable=True)
+def run_import_files(context, params):
+    """
+    Store files in place, chunk at a time; used by bulk imports of a
+    directory tree. The [category, path] pairs are read from the staging
+    directory written by stage_file_list().
+    """
+    directory = params['directory']
+    with open(os.path.join(directory, 'files.json')) as f:
+        files = [(category, os.path.basename(path), path) for category, path in json.load(f)]
+    try:
+        added, errors = _import_files(
+            context, SessionUser(context.user_id, params['username']), files, params.get('chunk', IMPORT_CHUNK)
+        )
+    except JobCancelled:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+    # Failed imports keep their list so that they can be retried
+    shutil.rmtree(directory, ignore_errors=True)
+    if added:
+        # Usually run by the command-line tool; the app's indexes are elsewhere
+        from suggestions import invalidate_suggestion_indexes
+
+        invalidate_suggestion_indexes()
+    return {'added': added, 'errors': errors}
+
+@handler('thumbnails', cancellable=True)
+def run_thumbnails(context, params):
+    from storage import evict_thumbnails, get_upload_executor, regenerate_thumbnails
+
+    session = open_session()
+    try:
+        images = session.query(Image.id, Image.path).filter_by(user_id=context.user_id).all()
+    finally:
+        session.close()
+    generated = 0
+    failed = 0
+    context.progress(0, len(images))
+    for start in range(0, len(images), THUMBNAIL_CHUNK):
+        chunk_generated, chunk_failed = regenerate_thumbnails(
+            images[start:start + THUMBNAIL_CHUNK], force=params.get('force', False),
+            executor=get_upload_executor(), evict=False
+        )
+        generated += chunk_generated
+        failed += chunk_failed
+        context.progress(min(start + THUMBNAIL_CHUNK, len(images)), len(images))
+    evict_thumbnails()
+    return {'generated': generated, 'failed': failed}
+
+@handler('sync')
+def run_sync(context, params):
+    from storage import sync_upload_directory
+
+    session = open_session()
+    try:
+        new_images, removed_images = sync_upload_directory(
+            session, SessionUser(context.user_id, params['username'])
+        )
+        return {'added': len(new_images), 'removed': len(removed_images)}
+    finally:
+        session.close()
+
+@handler('backup', scope='global')
+def run_backup(context, params):
+    from backup import create_backup
+
+    # Not cancellable: an archive append cannot be abandoned half way
+    return {'path': create_backup(context.progress)}
+
+@handler('restore', scope='exclusive')
+def run_restore(context, params):
+    """
+    Restore an archive; uploaded archives (remove=True) are deleted
+    afterwards. The jobs table is kept as it is (see
+    backup.restore_database), so the job history, this job included,
+    survives the restore.
+    """
+    from backup import restore_backup
+
+    restored, skipped = restore_backup(params['path'], context.progress)
+    if params.get('remove'):
+        os.remove(params['path'])
+    return {'restored': restored, 'skipped': skipped}
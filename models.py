@@ -0,0 +1,93 @@
+"""
+Database models and indexes.
+"""
+from sqlalchemy import Column, Integer, String, Boolean, Float, ForeignKey, Index, func
+from sqlalchemy.orm import relationship, declarative_base
+
+Base = declarative_base()
+
+class User(Base):
+    __tablename__ = 'users'
+    id = Column(Integer, primary_key=True)
+    username = Column(String, unique=True, nullable=False)
+    password = Column(String, nullable=False)
+    images = relationship('Image', back_populates='user')
+    dislikes = relationship('Dislike', back_populates='user')
+    favorites = relationship('Favorite', back_populates='user')
+
+class Image(Base):
+    __tablename__ = 'images'
+    id = Column(Integer, primary_key=True)
+    category = Column(String)
+    path = Column(String)
+    # sha256 of the stored (normalized) file and of the bytes as uploaded
+    content_hash = Column(String, nullable=True)
+    source_hash = Column(String, nullable=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    user = relationship('User', back_populates='images')
+
+class Dislike(Base):
+    __tablename__ = 'dislikes'
+    id = Column(Integer, primary_key=True)
+    top_id = Column(Integer, ForeignKey('images.id'))
+    bottom_id = Column(Integer, ForeignKey('images.id'))
+    shoes_id = Column(Integer, ForeignKey('images.id'), nullable=True)
+    accessory_id = Column(Integer, ForeignKey('images.id'), nullable=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    user = relationship('User', back_populates='dislikes')
+    top = relationship('Image', foreign_keys=[top_id])
+    bottom = relationship('Image', foreign_keys=[bottom_id])
+    shoes = relationship('Image', foreign_keys=[shoes_id])
+    accessory = relationship('Image', foreign_keys=[accessory_id])
+
+class Favorite(Base):
+    __tablename__ = 'favorites'
+    id = Column(Integer, primary_key=True)
+    top_id = Column(Integer, ForeignKey('images.id'))
+    bottom_id = Column(Integer, ForeignKey('images.id'))
+    shoes_id = Column(Integer, ForeignKey('images.id'), nullable=True)
+    accessory_id = Column(Integer, ForeignKey('images.id'), nullable=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    user = relationship('User', back_populates='favorites')
+    top = relationship('Image', foreign_keys=[top_id])
+    bottom = relationship('Image', foreign_keys=[bottom_id])
+    shoes = relationship('Image', foreign_keys=[shoes_id])
+    accessory = relationship('Image', foreign_keys=[accessory_id])
+
+class Job(Base):
+    __tablename__ = 'jobs'
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    # queued, running, succeeded, failed, cancelled or interrupted
+    status = Column(String, nullable=False, default='queued')
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=True)
+    # JSON encoded handler arguments and return value
+    params = Column(String, nullable=False, default='{}')
+    result = Column(String, nullable=True)
+    error = Column(String, nullable=True)
+    done = Column(Integer, nullable=False, default=0)
+    total = Column(Integer, nullable=False, default=0)
+    cancel_requested = Column(Boolean, nullable=False, default=False)
+    # pid of the process running the job
+    owner = Column(Integer, nullable=True)
+    created_at = Column(Float, nullable=False)
+    started_at = Column(Float, nullable=True)
+    finished_at = Column(Float, nullable=True)
+
+class Setting(Base):
+    __tablename__ = 'settings'
+    name = Column(String, primary_key=True)
+    value = Column(String, nullable=True)
+
+Index('ix_images_user_category', Image.user_id, Image.category)
+Index('ux_images_user_path', Image.user_id, Image.path, unique=True)
+Index('ix_images_path', Image.path)
+Index('ix_images_user_source_hash', Image.user_id, Image.source_hash)
+# NULL shoes/accessory ids are folded to 0 so that they compare equal
+for model in (Dislike, Favorite):
+    Index(
+        f'ux_{model.__tablename__}_combination', model.user_id, model.top_id, model.bottom_id,
+        func.coalesce(model.shoes_id, 0), func.coalesce(model.accessory_id, 0), unique=True
+    )
+Index('ix_jobs_status', Job.status)
+Index('ix_jobs_user', Job.user_id, Job.id)
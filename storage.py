@@ -0,0 +1,632 @@
+"""
+Uploaded images on disk: the blob store, the user upload directories,
+thumbnails and outfit collages.
+
+Image codecs are only imported (through imaging) when an image is actually
+decoded or encoded.
+"""
+import hashlib
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+import instrumentation
+from models import Image, Dislike, Favorite
+from suggestions import get_suggestion_index
+
+# Directory for uploaded images
+UPLOAD_DIR = 'uploads'
+
+# Uploads are stored once per content under BLOB_DIR/<hash[:2]>/<hash>.<ext>
+BLOB_DIR = os.path.join(UPLOAD_DIR, '.blobs')
+# Uploads touch the blob they store or reuse, and unreferenced blobs are
+# only deleted once they are older than this: an upload may be about to
+# commit a row for them
+BLOB_GRACE_SECONDS = 600
+
+# Uploads are decoded on a process pool and downscaled to fit this size
+UPLOAD_MAX_DIMENSION = int(os.environ.get('CORDINATE_MAX_DIMENSION', '2048'))
+UPLOAD_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+
+# Thumbnails are derived from the originals and stored as
+# THUMBNAIL_DIR/<image id>/<source mtime>_<size>.jpg
+THUMBNAIL_DIR = 'thumbnails'
+THUMBNAIL_SIZES = (150, 300)
+THUMBNAIL_MAX_BYTES = 200 * 1024 * 1024
+
+# Outfit collages: one strip of square tiles per (top, bottom, shoes,
+# accessory) tuple, stored as COLLAGE_DIR/<ids>_<member mtimes digest>.jpg
+# and kept in an in-memory LRU of COLLAGE_CACHE_SIZE entries.
+COLLAGE_DIR = os.path.join(THUMBNAIL_DIR, 'collages')
+COLLAGE_TILE_SIZE = 150
+COLLAGE_CACHE_SIZE = 256
+
+# Upload page gallery grid
+GALLERY_PAGE_SIZE = 24
+
+logger = logging.getLogger('cordinate.storage')
+
+def ensure_directories():
+    for directory in (UPLOAD_DIR, THUMBNAIL_DIR):
+        os.makedirs(directory, exist_ok=True)
+
+def thumbnail_path(image_id, source_path, size):
+    mtime = os.stat(source_path).st_mtime_ns
+    return os.path.join(THUMBNAIL_DIR, str(image_id), f'{mtime}_{size}.jpg')
+
+def _prune_thumbnails(image_id, keep_paths):
+    # Drop thumbnails of older versions of the source image, but not the
+    # partial files of other writers, which they are about to rename
+    thumb_dir = os.path.join(THUMBNAIL_DIR, str(image_id))
+    for file_name in os.listdir(thumb_dir):
+        file_path = os.path.join(thumb_dir, file_name)
+        if file_path not in keep_paths and not file_name.endswith('.tmp'):
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+def generate_thumbnail(image_id, source_path, size):
+    """
+    Create the thumbnail of the given size unless an up-to-date one exists.
+    """
+    thumb_path = thumbnail_path(image_id, source_path, size)
+    if os.path.exists(thumb_path):
+        return thumb_path
+    import imaging
+
+    os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+    imaging.write_thumbnails(source_path, [(thumb_path, size)])
+    _prune_thumbnails(image_id, [thumbnail_path(image_id, source_path, size) for size in THUMBNAIL_SIZES])
+    record_cache_write(os.path.getsize(thumb_path))
+    return thumb_path
+
+@instrumentation.timed('image_io')
+def get_thumbnail(image_id, source_path, size=150):
+    """
+    Return the thumbnail path to display, falling back to the original image.
+    """
+    try:
+        return generate_thumbnail(image_id, source_path, size)
+    except Exception:
+        return source_path
+
+def delete_thumbnails(image_id):
+    """
+    Remove the thumbnails of the image and every collage it appears in.
+    """
+    shutil.rmtree(os.path.join(THUMBNAIL_DIR, str(image_id)), ignore_errors=True)
+    invalidate_collages(image_id)
+
+class CollageCache:
+    """
+    Thread-safe LRU of collage JPEG bytes keyed by (id tuple, member mtimes).
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        with self.lock:
+            self.entries[key] = data
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, image_id):
+        with self.lock:
+            for key in [key for key in self.entries if image_id in key[0]]:
+                del self.entries[key]
+
+_collages = CollageCache(COLLAGE_CACHE_SIZE)
+
+def _collage_prefix(combination):
+    return '_'.join(str(image_id or 0) for image_id in combination) + '_'
+
+@instrumentation.timed('image_io')
+def get_collage(combination, paths):
+    """
+    Return JPEG bytes of the collage for a (top, bottom, shoes, accessory)
+    id tuple. paths maps image ids to their source paths; ids missing from
+    it are left out of the collage.
+    """
+    members = [(image_id, paths[image_id]) for image_id in combination if image_id in paths]
+    mtimes = tuple(os.stat(path).st_mtime_ns for image_id, path in members)
+    key = (tuple(combination), mtimes)
+    data = _collages.get(key)
+    if data is not None:
+        return data
+
+    digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+    prefix = _collage_prefix(combination)
+    collage_path = os.path.join(COLLAGE_DIR, f'{prefix}{digest}.jpg')
+    if os.path.exists(collage_path):
+        with open(collage_path, 'rb') as f:
+            data = f.read()
+    else:
+        import imaging
+
+        data = imaging.render_collage(
+            [get_thumbnail(image_id, path, COLLAGE_TILE_SIZE) for image_id, path in members], COLLAGE_TILE_SIZE
+        )
+        os.makedirs(COLLAGE_DIR, exist_ok=True)
+        # Collages of older versions of the member images, but not the
+        # partial files of concurrent renders
+        for file_name in os.listdir(COLLAGE_DIR):
+            if file_name.startswith(prefix) and not file_name.endswith('.tmp'):
+                try:
+                    os.remove(os.path.join(COLLAGE_DIR, file_name))
+                except FileNotFoundError:
+                    pass
+        tmp_path = f'{collage_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, collage_path)
+        record_cache_write(len(data))
+    _collages.put(key, data)
+    return data
+
+def invalidate_collages(image_id):
+    _collages.invalidate(image_id)
+    if not os.path.exists(COLLAGE_DIR):
+        return
+    image_id = str(image_id)
+    for file_name in os.listdir(COLLAGE_DIR):
+        if image_id in file_name.split('_')[:4]:
+            try:
+                os.remove(os.path.join(COLLAGE_DIR, file_name))
+            except FileNotFoundError:
+                pass
+
+# Estimated size of THUMBNAIL_DIR: its size after the last eviction plus
+# what this process wrote since, None until the first eviction
+_cache_bytes = None
+_cache_bytes_lock = threading.Lock()
+_eviction_lock = threading.Lock()
+
+def record_cache_write(size):
+    """
+    Account for a thumbnail or collage written on demand and evict once
+    the cache may have outgrown its budget.
+    """
+    global _cache_bytes
+    with _cache_bytes_lock:
+        if _cache_bytes is not None:
+            _cache_bytes += size
+            if _cache_bytes <= THUMBNAIL_MAX_BYTES:
+                return
+    # One eviction at a time; concurrent writers do not wait for it
+    if _eviction_lock.acquire(blocking=False):
+        try:
+            evict_thumbnails()
+        finally:
+            _eviction_lock.release()
+
+def evict_thumbnails(max_bytes=THUMBNAIL_MAX_BYTES):
+    """
+    Remove the least recently used thumbnails until the cache fits in max_bytes.
+    """
+    global _cache_bytes
+    entries = []
+    total = 0
+    for root, dirs, files in os.walk(THUMBNAIL_DIR):
+        for file in files:
+            # Partial files of writers that are about to rename them
+            if file.endswith('.tmp'):
+                continue
+            file_path = os.path.join(root, file)
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, file_path))
+            total += stat.st_size
+    if total <= max_bytes:
+        with _cache_bytes_lock:
+            _cache_bytes = total
+        return 0
+    removed = 0
+    for atime, size, file_path in sorted(entries):
+        if total <= max_bytes:
+            break
+        total -= size
+        # Writers and delete_thumbnails() work on the directory meanwhile
+        try:
+            os.remove(file_path)
+            removed += 1
+            thumb_dir = os.path.dirname(file_path)
+            if not os.listdir(thumb_dir):
+                os.rmdir(thumb_dir)
+        except OSError:
+            pass
+    with _cache_bytes_lock:
+        _cache_bytes = total
+    return removed
+
+@instrumentation.timed('image_io')
+def regenerate_thumbnails(images, force=False, executor=None, evict=True):
+    """
+    Rebuild missing or stale thumbnails for (image id, path) pairs in bulk,
+    decoding each source once for all sizes. With an executor the images
+    are decoded in parallel. With force=True existing thumbnails are
+    discarded first. Returns the numbers of up-to-date and failed images.
+    """
+    import imaging
+
+    pending = []
+    failed = 0
+    for image_id, source_path in images:
+        if force:
+            delete_thumbnails(image_id)
+        try:
+            paths = [thumbnail_path(image_id, source_path, size) for size in THUMBNAIL_SIZES]
+        except OSError as e:
+            logger.warning("thumbnail generation failed for %s: %s", source_path, e)
+            failed += 1
+            continue
+        targets = [(path, size) for path, size in zip(paths, THUMBNAIL_SIZES) if not os.path.exists(path)]
+        result = None
+        if targets:
+            os.makedirs(os.path.dirname(paths[0]), exist_ok=True)
+            if executor is not None:
+                result = executor.submit(imaging.write_thumbnails, source_path, targets)
+            else:
+                try:
+                    imaging.write_thumbnails(source_path, targets)
+                except Exception as e:
+                    result = e
+        pending.append((image_id, source_path, paths, result))
+
+    generated = 0
+    for image_id, source_path, paths, result in pending:
+        try:
+            if isinstance(result, Exception):
+                raise result
+            if result is not None:
+                result.result()
+            _prune_thumbnails(image_id, paths)
+            generated += 1
+        except Exception as e:
+            logger.warning("thumbnail generation failed for %s: %s", source_path, e)
+            failed += 1
+    if evict:
+        evict_thumbnails()
+    return generated, failed
+
+def delete_feedback(session, image_ids):
+    """
+    Delete the Favorite and Dislike rows that refer to any of the images,
+    in the session's transaction; ids of deleted images are reused by
+    SQLite. Returns the removed (model, user id, combination) entries for
+    forget_feedback() once committed.
+    """
+    image_ids = list(image_ids)
+    removed = []
+    if not image_ids:
+        return removed
+    for model in (Favorite, Dislike):
+        columns = (model.top_id, model.bottom_id, model.shoes_id, model.accessory_id)
+        rows = session.query(model.id, model.user_id, *columns).filter(
+            or_(*(column.in_(image_ids) for column in columns))
+        ).all()
+        if rows:
+            session.query(model).filter(model.id.in_([row[0] for row in rows])).delete(synchronize_session=False)
+            removed += [(model, row[1], tuple(row[2:])) for row in rows]
+    return removed
+
+def forget_feedback(removed):
+    """
+    Drop feedback deleted by delete_feedback() from the suggestion indexes.
+    """
+    indexes = {}
+    for model, user_id, combination in removed:
+        if user_id not in indexes:
+            indexes[user_id] = get_suggestion_index(user_id)
+        if model is Dislike:
+            indexes[user_id].remove_dislike(combination)
+        else:
+            indexes[user_id].remove_favorite(combination)
+
+# Last scan of each upload directory: (directory mtime, {path: (size, mtime)})
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+def clear_directory_snapshots():
+    with _snapshots_lock:
+        _snapshots.clear()
+
+def directory_changed(user):
+    """
+    Whether sync_upload_directory() would rescan the user's directory.
+    """
+    user_upload_dir = os.path.join(UPLOAD_DIR, user.username)
+    try:
+        dir_mtime = os.stat(user_upload_dir).st_mtime_ns
+    except FileNotFoundError:
+        return True
+    with _snapshots_lock:
+        snapshot = _snapshots.get(user_upload_dir)
+    if snapshot is None:
+        return True
+    if snapshot[0] is None:
+        # Rescanned within a second of a change; scan again once the
+        # directory has been quiet long enough for its mtime to be trusted
+        return time.time_ns() - dir_mtime >= 1_000_000_000
+    return snapshot[0] != dir_mtime
+
+@instrumentation.timed('directory_sync')
+def sync_upload_directory(session, user):
+    """
+    Bring the images table in line with the user's upload directory.
+
+    The directory is rescanned only when its mtime changed since the last
+    scan. The scan is diffed against the cached {path: (size, mtime)}
+    snapshot, or on the first scan in the process against the rows of the
+    directory, so that files deleted meanwhile are noticed: new files are
+    checked against the known paths with a single query and inserted in
+    bulk, and rows of files that disappeared are removed. Returns the
+    lists of added and removed Image rows.
+    """
+    user_upload_dir = os.path.join(UPLOAD_DIR, user.username)
+    if not os.path.exists(user_upload_dir):
+        os.makedirs(user_upload_dir)
+    scan_time = time.time_ns()
+    dir_mtime = os.stat(user_upload_dir).st_mtime_ns
+    with _snapshots_lock:
+        snapshot = _snapshots.get(user_upload_dir)
+    if snapshot is not None and snapshot[0] == dir_mtime:
+        return [], []
+
+    entries = {}
+    with os.scandir(user_upload_dir) as it:
+        for entry in it:
+            if entry.is_file():
+                stat = entry.stat()
+                entries[entry.path] = (stat.st_size, stat.st_mtime_ns)
+    known_paths = None
+    if snapshot is not None:
+        previous = snapshot[1]
+    else:
+        # First scan in this process: rows of files deleted while it was
+        # not running are only found by comparing with the database
+        known_paths = {path for (path,) in session.query(Image.path).filter_by(user_id=user.id)}
+        previous = {path: None for path in known_paths if os.path.dirname(path) == user_upload_dir}
+    added_paths = [path for path in entries if path not in previous]
+    removed_paths = [path for path in previous if path not in entries]
+
+    new_images = []
+    if added_paths:
+        if known_paths is None:
+            known_paths = {path for (path,) in session.query(Image.path).filter_by(user_id=user.id)}
+        category = '未分類'  # Default category if not assigned
+        new_images = [
+            Image(category=category.lower(), path=path, user_id=user.id)
+            for path in added_paths if path not in known_paths
+        ]
+    removed_images = []
+    if removed_paths:
+        removed_images = session.query(Image).filter(
+            Image.user_id == user.id, Image.path.in_(removed_paths)
+        ).all()
+    removed_feedback = []
+    if new_images or removed_images:
+        session.add_all(new_images)
+        for image in removed_images:
+            session.delete(image)
+        removed_feedback = delete_feedback(session, [image.id for image in removed_images])
+        try:
+            session.flush()
+            # Read before the commit expires the rows, which would reload
+            # them one query at a time
+            added = [(image.id, image.path) for image in new_images]
+            session.commit()
+        except IntegrityError:
+            # Another session registered the same files first; rescan next run
+            session.rollback()
+            with _snapshots_lock:
+                _snapshots.pop(user_upload_dir, None)
+            return [], []
+
+    for image in removed_images:
+        delete_thumbnails(image.id)
+        get_suggestion_index(user.id).remove_image(image.id)
+    forget_feedback(removed_feedback)
+    if new_images:
+        regenerate_thumbnails(added)
+    # A directory modified within the last second may change again without
+    # its mtime moving, so such a snapshot is not trusted next time.
+    if scan_time - dir_mtime < 1_000_000_000:
+        dir_mtime = None
+    with _snapshots_lock:
+        _snapshots[user_upload_dir] = (dir_mtime, entries)
+    return new_images, removed_images
+
+_upload_executor = None
+_upload_executor_lock = threading.Lock()
+
+def get_upload_executor():
+    """
+    Return the process pool used to decode images, starting it on first use.
+    """
+    global _upload_executor
+    with _upload_executor_lock:
+        if _upload_executor is None:
+            # spawn: forking the multi-threaded Streamlit server is not safe
+            _upload_executor = ProcessPoolExecutor(
+                max_workers=UPLOAD_WORKERS, mp_context=multiprocessing.get_context('spawn')
+            )
+        return _upload_executor
+
+def _discard_upload_executor(executor):
+    global _upload_executor
+    with _upload_executor_lock:
+        if _upload_executor is executor:
+            _upload_executor = None
+
+def shutdown_upload_executor():
+    """
+    Stop the decoding processes; used by scripts before they exit.
+    """
+    global _upload_executor
+    with _upload_executor_lock:
+        executor, _upload_executor = _upload_executor, None
+    if executor is not None:
+        executor.shutdown()
+
+@instrumentation.timed('image_io')
+def upload_images(session, user, uploads, category, evict=True):
+    """
+    Store a batch of uploaded images for the user.
+
+    uploads is a list of (file name, bytes). Files whose bytes the user has
+    uploaded before are skipped with a single indexed lookup, before any
+    decoding. The others are decoded, oriented, downscaled and written to
+    the content-addressed blob store by the process pool, and the new rows
+    are inserted in a single commit; files registered concurrently by
+    another upload are reported as already registered. Bulk imports pass
+    evict=False and evict the thumbnail cache once at the end. Returns the
+    new Image rows and a list of (file name, error message) for the files
+    that were not added.
+    """
+    import imaging
+
+    executor = get_upload_executor()
+    errors = []
+    source_hashes = [(file_name, data, hashlib.sha256(data).hexdigest()) for file_name, data in uploads]
+    known_sources = {source_hash for (source_hash,) in session.query(Image.source_hash).filter(
+        Image.user_id == user.id, Image.source_hash.in_([source_hash for _, _, source_hash in source_hashes])
+    )}
+    pending = {}
+    for file_name, data, source_hash in source_hashes:
+        if source_hash in known_sources or source_hash in pending:
+            errors.append((file_name, "既に登録されています。"))
+            continue
+        pending[source_hash] = (file_name, executor.submit(
+            imaging.normalize_image, data, file_name, BLOB_DIR, UPLOAD_MAX_DIMENSION
+        ))
+
+    written = {}
+    for source_hash, (file_name, future) in pending.items():
+        try:
+            content_hash, file_path = future.result()
+        except BrokenProcessPool as e:
+            # A crashed worker breaks the pool for good; start a new one next time
+            _discard_upload_executor(executor)
+            errors.append((file_name, str(e)))
+            continue
+        except Exception as e:
+            errors.append((file_name, str(e)))
+            continue
+        if file_path in written:
+            errors.append((file_name, "既に登録されています。"))
+            continue
+        written[file_path] = (file_name, source_hash, content_hash)
+    if not written:
+        return [], errors
+
+    # Different source bytes can still normalize to an image the user has
+    # already stored; those are not inserted a second time
+    known_paths = {path for (path,) in session.query(Image.path).filter(
+        Image.user_id == user.id, Image.path.in_(list(written))
+    )}
+    while True:
+        new_images = [
+            Image(
+                category=category.lower(), path=file_path, content_hash=content_hash,
+                source_hash=source_hash, user_id=user.id
+            )
+            for file_path, (file_name, source_hash, content_hash) in written.items() if file_path not in known_paths
+        ]
+        session.add_all(new_images)
+        try:
+            session.flush()
+            added = [(image.id, image.category, image.path) for image in new_images]
+            session.commit()
+            break
+        except IntegrityError:
+            # A concurrent upload (another session, a job, the command line)
+            # registered some of the files first; skip those and insert the rest
+            session.rollback()
+            registered = {path for (path,) in session.query(Image.path).filter(
+                Image.user_id == user.id, Image.path.in_(list(written))
+            )}
+            if registered <= known_paths:
+                raise
+            known_paths = registered
+    errors += [
+        (file_name, "既に登録されています。")
+        for file_path, (file_name, source_hash, content_hash) in written.items() if file_path in known_paths
+    ]
+
+    regenerate_thumbnails([(image_id, path) for image_id, category, path in added], executor=executor, evict=evict)
+    index = get_suggestion_index(user.id)
+    for image_id, category, path in added:
+        index.add_image(image_id, category, path)
+    return new_images, errors
+
+def delete_images(session, user, image_ids):
+    """
+    Delete the user's images and the feedback that refers to them in one
+    transaction. A stored file is removed only once no image row of any
+    user refers to it any more, and blobs only once BLOB_GRACE_SECONDS
+    passed since an upload last stored them; the command-line orphans
+    check removes those left behind.
+    Returns the number of deleted rows.
+    """
+    images = session.query(Image).filter(Image.user_id == user.id, Image.id.in_(image_ids)).all()
+    paths = {image.path for image in images}
+    for image in images:
+        session.delete(image)
+    removed_feedback = delete_feedback(session, [image.id for image in images])
+    session.commit()
+    referenced = {path for (path,) in session.query(Image.path).filter(Image.path.in_(paths)).distinct()}
+    cutoff = time.time() - BLOB_GRACE_SECONDS
+    for path in paths - referenced:
+        try:
+            if path.startswith(BLOB_DIR + os.sep) and os.stat(path).st_mtime >= cutoff:
+                continue
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    index = get_suggestion_index(user.id)
+    for image in images:
+        delete_thumbnails(image.id)
+        index.remove_image(image.id)
+    forget_feedback(removed_feedback)
+    return len(images)
+
+def _gallery_query(session, user_id, category):
+    query = session.query(Image.id, Image.category, Image.path).filter(Image.user_id == user_id)
+    if category is not None:
+        query = query.filter(Image.category == category)
+    return query
+
+def count_gallery_images(session, user_id, category):
+    return _gallery_query(session, user_id, category).count()
+
+def load_gallery_page(session, user_id, category, page, page_size=GALLERY_PAGE_SIZE):
+    """
+    Load one page of the user's (id, category, path) rows in the category
+    (None for all), newest first.
+    """
+    return _gallery_query(session, user_id, category).order_by(Image.id.desc()).limit(page_size).offset(
+        (page - 1) * page_size
+    ).all()
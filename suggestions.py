@@ -0,0 +1,453 @@
+"""
+Outfit suggestions and the favorite / dislike feedback they are based on.
+"""
+import bisect
+import random
+import threading
+import time
+import uuid
+
+from sqlalchemy.orm import joinedload
+
+import instrumentation
+from database import open_session
+from models import Image, Dislike, Favorite, Setting
+
+# Number of rows shown per page on the list pages
+PAGE_SIZE = 20
+
+# Sampled batch suggestions are seeded with the favorites and up to
+# SEED_PAIRS best-liked pairs per category pair, each completed
+# SEED_VARIANTS times
+SEED_PAIRS = 50
+SEED_VARIANTS = 4
+
+SUGGESTION_CATEGORIES = ('top', 'bottom', 'shoes', 'accessory')
+
+# Settings row holding a token that changes whenever images or feedback are
+# changed behind the loaded indexes' back (other processes, restores)
+GENERATION_SETTING = 'suggestion_generation'
+# The token is read at most once per this many seconds, so suggestions
+# normally need no database round-trip; changes made by other processes
+# show up within this delay
+GENERATION_CHECK_SECONDS = 5.0
+
+class SuggestionIndex:
+    """
+    In-memory view of one user's wardrobe used for outfit suggestions:
+    category -> image id arrays and the sets of disliked and favorite
+    (top, bottom, shoes, accessory) id tuples.
+    """
+
+    def __init__(self, images, dislikes, favorites=(), generation=None):
+        self.lock = threading.Lock()
+        self.generation = generation
+        self.ids = {category: [] for category in SUGGESTION_CATEGORIES}
+        self.positions = {category: {} for category in SUGGESTION_CATEGORIES}
+        self.categories = {}
+        self.paths = {}
+        self.dislikes = set(dislikes)
+        self.favorites = set(favorites)
+        # Sorted ranks of the disliked combinations and affinity arrays,
+        # per (include_shoes, include_accessory)
+        self._disliked_ranks = {}
+        self._affinities = {}
+        for image_id, category, path in images:
+            self._add_image(image_id, category, path)
+
+    @classmethod
+    def load(cls, session, user_id, generation=None):
+        images = session.query(Image.id, Image.category, Image.path).filter(
+            Image.user_id == user_id, Image.category.in_(SUGGESTION_CATEGORIES)
+        ).all()
+        dislikes = session.query(
+            Dislike.top_id, Dislike.bottom_id, Dislike.shoes_id, Dislike.accessory_id
+        ).filter_by(user_id=user_id).all()
+        favorites = session.query(
+            Favorite.top_id, Favorite.bottom_id, Favorite.shoes_id, Favorite.accessory_id
+        ).filter_by(user_id=user_id).all()
+        return cls(
+            images, [tuple(dislike) for dislike in dislikes], [tuple(favorite) for favorite in favorites],
+            generation
+        )
+
+    def _invalidate(self):
+        self._disliked_ranks.clear()
+        self._affinities.clear()
+
+    def _add_image(self, image_id, category, path):
+        if category not in self.positions or image_id in self.categories:
+            return
+        self.positions[category][image_id] = len(self.ids[category])
+        self.ids[category].append(image_id)
+        self.categories[image_id] = category
+        self.paths[image_id] = path
+
+    def add_image(self, image_id, category, path):
+        with self.lock:
+            self._add_image(image_id, category, path)
+            self._invalidate()
+
+    def remove_image(self, image_id):
+        with self.lock:
+            category = self.categories.pop(image_id, None)
+            if category is None:
+                return
+            del self.paths[image_id]
+            ids = self.ids[category]
+            positions = self.positions[category]
+            # Swap-remove keeps removal O(1)
+            position = positions.pop(image_id)
+            last_id = ids.pop()
+            if last_id != image_id:
+                ids[position] = last_id
+                positions[last_id] = position
+            self._invalidate()
+
+    def add_dislike(self, combination):
+        with self.lock:
+            self.dislikes.add(tuple(combination))
+            self._invalidate()
+
+    def remove_dislike(self, combination):
+        with self.lock:
+            self.dislikes.discard(tuple(combination))
+            self._invalidate()
+
+    def add_favorite(self, combination):
+        with self.lock:
+            self.favorites.add(tuple(combination))
+            self._invalidate()
+
+    def remove_favorite(self, combination):
+        with self.lock:
+            self.favorites.discard(tuple(combination))
+            self._invalidate()
+
+    def _axes(self, include_shoes, include_accessory):
+        shoes = self.ids['shoes'] if include_shoes and self.ids['shoes'] else [None]
+        accessory = self.ids['accessory'] if include_accessory and self.ids['accessory'] else [None]
+        return [self.ids['top'], self.ids['bottom'], shoes, accessory]
+
+    def _rank(self, axes, combination):
+        rank = 0
+        for axis, category, image_id in zip(axes, SUGGESTION_CATEGORIES, combination):
+            if axis[0] is None:
+                if image_id is not None:
+                    return None
+                position = 0
+            else:
+                position = self.positions[category].get(image_id)
+                if position is None:
+                    return None
+            rank = rank * len(axis) + position
+        return rank
+
+    def _combination(self, axes, rank):
+        combination = []
+        for axis in reversed(axes):
+            rank, position = divmod(rank, len(axis))
+            combination.append(axis[position])
+        return tuple(reversed(combination))
+
+    def disliked_ranks(self, include_shoes, include_accessory):
+        # Callers hold self.lock
+        key = (include_shoes, include_accessory)
+        ranks = self._disliked_ranks.get(key)
+        if ranks is None:
+            axes = self._axes(include_shoes, include_accessory)
+            ranks = sorted({
+                rank for rank in (self._rank(axes, dislike) for dislike in self.dislikes)
+                if rank is not None
+            })
+            self._disliked_ranks[key] = ranks
+        return ranks
+
+    def suggest(self, include_shoes, include_accessory):
+        """
+        Pick a combination uniformly among the non-disliked ones.
+        Returns None only when no such combination exists.
+        """
+        with self.lock:
+            axes = self._axes(include_shoes, include_accessory)
+            if not axes[0] or not axes[1]:
+                return None
+            total = 1
+            for axis in axes:
+                total *= len(axis)
+            disliked = self.disliked_ranks(include_shoes, include_accessory)
+            allowed = total - len(disliked)
+            if allowed <= 0:
+                return None
+            # Rank of the n-th allowed combination: the smallest rank r with
+            # r - (number of disliked ranks <= r) == n.
+            target = random.randrange(allowed)
+            rank = target
+            while True:
+                next_rank = target + bisect.bisect_right(disliked, rank)
+                if next_rank == rank:
+                    break
+                rank = next_rank
+            return self._combination(axes, rank)
+
+    def _positions(self, axes, combination):
+        positions = []
+        for axis, category, image_id in zip(axes, SUGGESTION_CATEGORIES, combination):
+            if axis[0] is None:
+                positions.append(0)
+            else:
+                positions.append(self.positions[category].get(image_id))
+        return positions
+
+    def affinities(self, include_shoes, include_accessory):
+        """
+        Per-item and per-pair affinity arrays built from the favorites (+1)
+        and dislikes (-1). Pair affinities are kept sparse as sorted
+        (pair key, score) arrays. Callers hold self.lock.
+        """
+        import numpy as np
+
+        key = (include_shoes, include_accessory)
+        affinities = self._affinities.get(key)
+        if affinities is not None:
+            return affinities
+        axes = self._axes(include_shoes, include_accessory)
+        item_scores = [np.zeros(len(axis)) for axis in axes]
+        pair_scores = {}
+        for combinations, weight in ((self.favorites, 1.0), (self.dislikes, -1.0)):
+            for combination in combinations:
+                positions = self._positions(axes, combination)
+                for i, position in enumerate(positions):
+                    if position is not None and axes[i][0] is not None:
+                        item_scores[i][position] += weight
+                for i in range(len(axes)):
+                    for j in range(i + 1, len(axes)):
+                        if positions[i] is None or positions[j] is None or axes[j][0] is None:
+                            continue
+                        scores = pair_scores.setdefault((i, j), {})
+                        pair_key = positions[i] * len(axes[j]) + positions[j]
+                        scores[pair_key] = scores.get(pair_key, 0.0) + weight
+        pairs = {}
+        for (i, j), scores in pair_scores.items():
+            keys = np.fromiter(scores.keys(), dtype=np.int64, count=len(scores))
+            values = np.fromiter(scores.values(), dtype=np.float64, count=len(scores))
+            order = np.argsort(keys)
+            pairs[(i, j)] = (keys[order], values[order])
+        affinities = (item_scores, pairs)
+        self._affinities[key] = affinities
+        return affinities
+
+    def _seed_positions(self, axes, sizes, pairs, probabilities, limit, rng):
+        """
+        Candidate positions per axis built from the favorites and the pairs
+        with the highest positive affinity; items they leave open are drawn
+        from probabilities. At most limit candidates. Callers hold self.lock.
+        """
+        import numpy as np
+
+        rows = []
+        for combination in self.favorites:
+            rows.append([-1 if position is None else position for position in self._positions(axes, combination)])
+        for (i, j), (keys, values) in pairs.items():
+            best = np.argsort(-values)[:SEED_PAIRS]
+            for key, value in zip(keys[best], values[best]):
+                if value <= 0:
+                    break
+                row = [-1] * len(axes)
+                row[i], row[j] = divmod(int(key), sizes[j])
+                rows.append(row)
+        rows = np.array(rows[:limit // SEED_VARIANTS], dtype=np.int64).reshape(-1, len(axes))
+        rows = np.repeat(rows, SEED_VARIANTS, axis=0)
+        for axis, p in enumerate(probabilities):
+            open_items = rows[:, axis] < 0
+            rows[open_items, axis] = rng.choice(len(p), size=int(open_items.sum()), p=p)
+        return [rows[:, axis] for axis in range(len(axes))]
+
+    def rank_outfits(self, n, include_shoes, include_accessory, rng=None):
+        """
+        Return up to n distinct non-disliked combinations, best first.
+
+        Small combination spaces are scored exhaustively; large ones are
+        scored on a sample drawn with a bias towards well-liked items plus
+        the favorites and best-liked pairs, so the cost depends on n and the
+        feedback size, not on the space size.
+        """
+        # numpy is only needed for batch suggestions
+        import numpy as np
+
+        rng = rng or np.random.default_rng()
+        with self.lock:
+            axes = self._axes(include_shoes, include_accessory)
+            if n <= 0 or not axes[0] or not axes[1]:
+                return []
+            sizes = [len(axis) for axis in axes]
+            total = 1
+            for size in sizes:
+                total *= size
+            item_scores, pairs = self.affinities(include_shoes, include_accessory)
+            disliked = np.array(self.disliked_ranks(include_shoes, include_accessory), dtype=np.int64)
+
+            sample_size = max(50 * n, 1000)
+            if total <= sample_size:
+                ranks = np.arange(total, dtype=np.int64)
+                positions = []
+                remainder = ranks
+                for size in reversed(sizes):
+                    remainder, position = np.divmod(remainder, size)
+                    positions.append(position)
+                positions.reverse()
+            else:
+                probabilities = []
+                for scores in item_scores:
+                    # Half uniform, half softmax over the item affinities
+                    weights = np.exp(scores - scores.max())
+                    p = 0.5 / len(scores) + 0.5 * weights / weights.sum()
+                    probabilities.append(p / p.sum())
+                positions = [rng.choice(len(p), size=sample_size, p=p) for p in probabilities]
+                # The draws above only follow per-item affinities and would
+                # rarely hit a favorite or a well-liked pair, so those are
+                # added as candidates of their own
+                seeds = self._seed_positions(axes, sizes, pairs, probabilities, sample_size, rng)
+                positions = [np.concatenate([drawn, seeded]) for drawn, seeded in zip(positions, seeds)]
+                ranks = np.zeros(len(positions[0]), dtype=np.int64)
+                for position, size in zip(positions, sizes):
+                    ranks = ranks * size + position
+                ranks, first = np.unique(ranks, return_index=True)
+                positions = [position[first] for position in positions]
+
+            keep = ~np.isin(ranks, disliked)
+            ranks = ranks[keep]
+            positions = [position[keep] for position in positions]
+            if not len(ranks):
+                return []
+
+            scores = np.zeros(len(ranks))
+            for position, item_score in zip(positions, item_scores):
+                scores += item_score[position]
+            for (i, j), (keys, values) in pairs.items():
+                pair_keys = positions[i] * sizes[j] + positions[j]
+                found = np.searchsorted(keys, pair_keys)
+                found = np.minimum(found, len(keys) - 1)
+                scores += np.where(keys[found] == pair_keys, values[found], 0.0)
+            # Gumbel noise varies the order among equally scored outfits
+            scores += 0.5 * rng.gumbel(size=len(scores))
+
+            best = np.argsort(-scores)[:n]
+            return [
+                tuple(axis[position[index]] for axis, position in zip(axes, positions))
+                for index in best
+            ]
+
+# Loaded indexes by user id, shared by every session of the process
+_indexes = {}
+_indexes_lock = threading.Lock()
+# (token, time.monotonic() of the read) of the last generation check
+_generation = (None, None)
+
+def _current_generation():
+    global _generation
+    generation, checked = _generation
+    now = time.monotonic()
+    if checked is not None and now - checked < GENERATION_CHECK_SECONDS:
+        return generation
+    session = open_session()
+    try:
+        generation = session.query(Setting.value).filter_by(name=GENERATION_SETTING).scalar()
+    finally:
+        session.close()
+    _generation = (generation, now)
+    return generation
+
+@instrumentation.timed('suggestion')
+def get_suggestion_index(user_id):
+    """
+    Return the user's index, reloading it when the generation token shows
+    that the database was changed elsewhere since it was loaded.
+    """
+    generation = _current_generation()
+    with _indexes_lock:
+        index = _indexes.get(user_id)
+        if index is None or index.generation != generation:
+            session = open_session()
+            try:
+                index = SuggestionIndex.load(session, user_id, generation)
+            finally:
+                session.close()
+            _indexes[user_id] = index
+    return index
+
+def clear_suggestion_indexes():
+    with _indexes_lock:
+        _indexes.clear()
+
+def invalidate_suggestion_indexes():
+    """
+    Make every process reload its indexes; called after changes that do
+    not go through the index methods, such as restores and command-line
+    maintenance.
+    """
+    global _generation
+    generation = uuid.uuid4().hex
+    session = open_session()
+    try:
+        session.merge(Setting(name=GENERATION_SETTING, value=generation))
+        session.commit()
+    finally:
+        session.close()
+    # This process sees its own change at once
+    _generation = (generation, time.monotonic())
+    clear_suggestion_indexes()
+
+@instrumentation.timed('suggestion')
+def get_random_suggestion(user_id, include_shoes, include_accessory):
+    return get_suggestion_index(user_id).suggest(include_shoes, include_accessory)
+
+@instrumentation.timed('suggestion')
+def suggest_outfits(user_id, n, include_shoes, include_accessory):
+    """
+    Return up to n distinct outfits for the user, ranked by preference.
+    """
+    return get_suggestion_index(user_id).rank_outfits(n, include_shoes, include_accessory)
+
+def record_feedback(session, model, user_id, combination):
+    """
+    Store a Favorite or Dislike row for the (top, bottom, shoes, accessory)
+    id tuple. Raises IntegrityError when the user already recorded it.
+    """
+    top_id, bottom_id, shoes_id, accessory_id = combination
+    session.add(model(
+        top_id=top_id,
+        bottom_id=bottom_id,
+        shoes_id=shoes_id,
+        accessory_id=accessory_id,
+        user_id=user_id
+    ))
+    session.commit()
+    index = get_suggestion_index(user_id)
+    if model is Dislike:
+        index.add_dislike(combination)
+    else:
+        index.add_favorite(combination)
+
+def remove_feedback(session, row):
+    """
+    Delete a Favorite or Dislike row.
+    """
+    combination = (row.top_id, row.bottom_id, row.shoes_id, row.accessory_id)
+    session.delete(row)
+    session.commit()
+    index = get_suggestion_index(row.user_id)
+    if isinstance(row, Dislike):
+        index.remove_dislike(combination)
+    else:
+        index.remove_favorite(combination)
+
+def load_combinations_page(session, model, user_id, page, page_size=PAGE_SIZE):
+    """
+    Load one page of Favorite or Dislike rows together with their images
+    in a single joined query, newest first.
+    """
+    return session.query(model).filter_by(user_id=user_id).options(
+        joinedload(model.top), joinedload(model.bottom),
+        joinedload(model.shoes), joinedload(model.accessory)
+    ).order_by(model.id.desc()).limit(page_size).offset((page - 1) * page_size).all()